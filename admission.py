@@ -0,0 +1,240 @@
+# Admission control, in front of every route.
+#
+# Requests are sorted into route classes. Logins hash with bcrypt and checkout writes
+# orders, so both get their own limits; probes, metrics and admin are never turned away.
+# A request is admitted when
+#   - the token buckets of its client IP and of its user (the bearer token's subject) and,
+#     for auth and checkout, the class bucket of that client have a token, else 429;
+#   - its class is below its concurrency limit, else 503;
+#   - the worker is not overloaded: requests in flight and the recent wait for a pooled
+#     connection are below the shedding thresholds, else 503.
+# Rejections are answered right away, before the request touches the database.
+import math
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+from database import pool_wait_stats
+from routers.users import decode_access_token
+
+# requests per second and burst; a rate of 0, the default, disables the bucket
+RATE_LIMIT_IP = float(os.getenv("RATE_LIMIT_IP", "0"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "100"))
+RATE_LIMIT_USER = float(os.getenv("RATE_LIMIT_USER", "0"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "50"))
+# per client, on top of the buckets above
+RATE_LIMIT_AUTH = float(os.getenv("RATE_LIMIT_AUTH", "0"))
+RATE_LIMIT_AUTH_BURST = float(os.getenv("RATE_LIMIT_AUTH_BURST", "10"))
+RATE_LIMIT_CHECKOUT = float(os.getenv("RATE_LIMIT_CHECKOUT", "0"))
+RATE_LIMIT_CHECKOUT_BURST = float(os.getenv("RATE_LIMIT_CHECKOUT_BURST", "5"))
+# clients with a bucket kept per worker, idle ones are dropped first
+RATE_LIMIT_CLIENTS = int(os.getenv("RATE_LIMIT_CLIENTS", "100000"))
+
+# requests of the class handled at once per worker, 0, the default, for no limit. Good
+# values: PASSWORD_HASH_QUEUE_LIMIT for auth, logins beyond the hash queue are refused
+# anyway; DB_POOL_SIZE for checkout, more would hold overflow connections on row locks
+CONCURRENCY_AUTH = int(os.getenv("CONCURRENCY_AUTH", "0"))
+CONCURRENCY_CHECKOUT = int(os.getenv("CONCURRENCY_CHECKOUT", "0"))
+CONCURRENCY_DEFAULT = int(os.getenv("CONCURRENCY_DEFAULT", "0"))
+
+# shed new requests above this many in flight per worker, 0, the default, to disable
+SHED_IN_FLIGHT = int(os.getenv("SHED_IN_FLIGHT", "0"))
+# shed new requests while the recent wait for a pooled connection is above this (ms), 0 to disable
+SHED_POOL_WAIT_MS = float(os.getenv("SHED_POOL_WAIT_MS", "0"))
+
+# admin is never turned away but checks its own token, see internal/admin.py
+EXEMPT_PREFIXES = ("/health", "/metrics", "/admin")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    # seconds until the next token
+    def retry_after(self):
+        return (1 - self.tokens) / self.rate
+
+
+# one bucket per client, least recently seen first
+class RateLimiter:
+    def __init__(self, name: str, rate: float, burst: float, maxsize: int = RATE_LIMIT_CLIENTS):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def bucket(self, key: str, now: float):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            bucket.updated = now
+            if len(self.buckets) > self.maxsize:
+                # the oldest client has been idle longest, its bucket is likely full again
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+
+class RouteClass:
+    def __init__(self, name: str, concurrency: int, limiter: RateLimiter | None = None, exempt: bool = False):
+        self.name = name
+        self.concurrency = concurrency
+        self.limiter = limiter
+        self.exempt = exempt
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = {}
+
+    def reject(self, reason: str):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+
+ip_limiter = RateLimiter("ip", RATE_LIMIT_IP, RATE_LIMIT_IP_BURST)
+user_limiter = RateLimiter("user", RATE_LIMIT_USER, RATE_LIMIT_USER_BURST)
+
+route_classes = {
+    "auth": RouteClass("auth", CONCURRENCY_AUTH, RateLimiter("auth", RATE_LIMIT_AUTH, RATE_LIMIT_AUTH_BURST)),
+    "checkout": RouteClass(
+        "checkout", CONCURRENCY_CHECKOUT, RateLimiter("checkout", RATE_LIMIT_CHECKOUT, RATE_LIMIT_CHECKOUT_BURST)),
+    "default": RouteClass("default", CONCURRENCY_DEFAULT),
+    "exempt": RouteClass("exempt", 0, exempt=True),
+}
+
+
+def classify(method: str, path: str):
+    if path.startswith(EXEMPT_PREFIXES):
+        return route_classes["exempt"]
+    # both hash a password
+    if method == "POST" and path in ("/users/token", "/users/register"):
+        return route_classes["auth"]
+    if method == "POST" and path == "/transactions/checkout":
+        return route_classes["checkout"]
+    return route_classes["default"]
+
+
+# the bearer token's subject; an invalid token is left to the endpoint and counted by IP
+def token_subject(scope):
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() != "bearer" or not token:
+                return None
+            try:
+                return decode_access_token(token)["sub"]
+            except HTTPException:
+                return None
+    return None
+
+
+def in_flight():
+    return sum(route_class.in_flight for route_class in route_classes.values() if not route_class.exempt)
+
+
+def overloaded():
+    if SHED_IN_FLIGHT and in_flight() >= SHED_IN_FLIGHT:
+        return "in_flight"
+    if SHED_POOL_WAIT_MS and pool_wait_stats.recent_wait() * 1000 >= SHED_POOL_WAIT_MS:
+        return "pool_wait"
+    return None
+
+
+def rejection(status_code: int, detail: str, retry_after: float):
+    return JSONResponse(
+        {"detail": detail}, status_code=status_code, headers={"Retry-After": str(max(math.ceil(retry_after), 1))}
+    )
+
+
+# returns a response for a request that is turned away, None when it may go ahead
+def admit(route_class: RouteClass, scope):
+    if route_class.exempt:
+        return None
+
+    now = time.monotonic()
+    client = scope.get("client")
+    ip = client[0] if client else "unknown"
+    class_limited = route_class.limiter is not None and route_class.limiter.enabled
+    user = token_subject(scope) if user_limiter.enabled or class_limited else None
+    # the class buckets count users when they are known, the client otherwise
+    principal = f"user:{user}" if user is not None else f"ip:{ip}"
+    checks = [(ip_limiter, ip), (user_limiter, user), (route_class.limiter, principal)]
+    for limiter, key in checks:
+        if limiter is None or not limiter.enabled or key is None:
+            continue
+        bucket = limiter.bucket(key, now)
+        if not bucket.take(now):
+            route_class.reject(f"rate_{limiter.name}")
+            return rejection(429, "Too many requests, slow down", bucket.retry_after())
+
+    if route_class.concurrency and route_class.in_flight >= route_class.concurrency:
+        route_class.reject("concurrency")
+        return rejection(503, "Too many requests of this kind at the moment, try again shortly", 1)
+
+    reason = overloaded()
+    if reason is not None:
+        route_class.reject(reason)
+        return rejection(503, "The service is overloaded, try again shortly", 1)
+    return None
+
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route_class = classify(scope["method"], scope["path"])
+        response = admit(route_class, scope)
+        if response is not None:
+            await response(scope, receive, send)
+            return
+
+        route_class.admitted += 1
+        route_class.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route_class.in_flight -= 1
+
+
+def admission_stats():
+    return {
+        "in_flight": in_flight(),
+        "recent_pool_wait_ms": round(pool_wait_stats.recent_wait() * 1000, 3),
+        "classes": {
+            name: {
+                "in_flight": route_class.in_flight,
+                "concurrency": route_class.concurrency,
+                "admitted": route_class.admitted,
+                "rejected": dict(route_class.rejected),
+            }
+            for name, route_class in route_classes.items()
+        },
+        "clients": {limiter.name: len(limiter.buckets) for limiter in (
+            ip_limiter, user_limiter, *(c.limiter for c in route_classes.values() if c.limiter is not None))},
+    }
@@ -0,0 +1,111 @@
+# p99 latency of concurrent product and cart reads against a running server.
+#
+# Run it once against the server before a change and once after, then compare:
+#   python -m benchmarks.latency --url http://127.0.0.1:8000 --username alice --out before.json
+#   python -m benchmarks.latency --url http://127.0.0.1:8000 --username alice --out after.json
+#   python -m benchmarks.latency --compare before.json after.json
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+
+def percentile(samples: list[float], pct: float):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples: list[float], errors: int, elapsed: float):
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(statistics.fmean(samples), 2) if samples else 0.0,
+        "p50_ms": round(percentile(samples, 50), 2),
+        "p95_ms": round(percentile(samples, 95), 2),
+        "p99_ms": round(percentile(samples, 99), 2),
+    }
+
+
+async def client_loop(client: httpx.AsyncClient, paths: list[str], requests: int, samples: dict, errors: dict):
+    for i in range(requests):
+        path = paths[i % len(paths)]
+        start = time.perf_counter()
+        try:
+            response = await client.get(path)
+            ok = response.status_code < 500
+        except httpx.HTTPError:
+            ok = False
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if ok:
+            samples[path].append(elapsed_ms)
+        else:
+            errors[path] += 1
+
+
+async def run(url: str, username: str, clients: int, requests: int):
+    paths = ["/products/product_list", f"/carts/view-items?username={username}"]
+    samples = {path: [] for path in paths}
+    errors = {path: 0 for path in paths}
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            client_loop(client, paths[i % 2:] + paths[:i % 2], requests, samples, errors)
+            for i in range(clients)
+        ))
+        elapsed = time.perf_counter() - start
+
+    every = [sample for path in paths for sample in samples[path]]
+    return {
+        "clients": clients,
+        "requests_per_client": requests,
+        "total": summarize(every, sum(errors.values()), elapsed),
+        "endpoints": {path.split("?")[0]: summarize(samples[path], errors[path], elapsed) for path in paths},
+    }
+
+
+def compare(before_path: str, after_path: str):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    print(f"{'endpoint':<28}{'p99 before':>12}{'p99 after':>12}{'change':>10}")
+    rows = [("total", before["total"], after["total"])]
+    rows += [(name, before["endpoints"][name], after["endpoints"][name]) for name in before["endpoints"]]
+    for name, old, new in rows:
+        change = (new["p99_ms"] - old["p99_ms"]) / old["p99_ms"] * 100 if old["p99_ms"] else 0.0
+        print(f"{name:<28}{old['p99_ms']:>10.1f}ms{new['p99_ms']:>10.1f}ms{change:>9.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="p99 latency under concurrent product and cart reads")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--username", default="bench", help="user that owns a cart with items")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=25, help="requests per client")
+    parser.add_argument("--out", help="write the results to this json file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = asyncio.run(run(args.url, args.username, args.clients, args.requests))
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
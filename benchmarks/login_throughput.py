@@ -0,0 +1,101 @@
+# Login throughput as the password hashing pool grows.
+#
+# Hashing only, one run per pool size from 1 up to the number of cores:
+#   python -m benchmarks.login_throughput --logins 200
+# Against a running server, with PASSWORD_HASH_WORKERS set on the server side:
+#   python -m benchmarks.login_throughput --url http://127.0.0.1:8000 --clients 64 --logins 400
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+from security import BCRYPT_ROUNDS, PasswordHasher, pwd_context
+
+
+async def hash_pool_run(workers: int, logins: int, hashed: str):
+    hasher = PasswordHasher(workers=workers, queue_limit=logins)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(hasher.verify_and_update("secret", hashed) for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    hasher.executor.shutdown()
+    assert all(valid for valid, _ in results)
+    return {
+        "workers": workers, "logins": logins, "seconds": round(elapsed, 3),
+        "logins_per_s": round(logins / elapsed, 1),
+    }
+
+
+def pool_sizes(cores: int):
+    sizes = [1]
+    while sizes[-1] * 2 < cores:
+        sizes.append(sizes[-1] * 2)
+    if cores > 1:
+        sizes.append(cores)
+    return sizes
+
+
+async def hashing_benchmark(logins: int):
+    hashed = pwd_context.hash("secret")
+    runs = []
+    for workers in pool_sizes(os.cpu_count() or 1):
+        run = await hash_pool_run(workers, logins, hashed)
+        runs.append(run)
+        print(f"{workers:>3} workers: {run['logins_per_s']:>8.1f} logins/s")
+    base = runs[0]["logins_per_s"]
+    for run in runs:
+        run["speedup"] = round(run["logins_per_s"] / base, 2)
+    return {"bcrypt_rounds": BCRYPT_ROUNDS, "cores": os.cpu_count(), "runs": runs}
+
+
+async def http_benchmark(url: str, clients: int, logins: int):
+    user = {
+        "username": "login-bench", "email": "login-bench@example.com", "full_name": "Login Bench", "password": "secret",
+    }
+    form = {"username": user["username"], "password": user["password"]}
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        await client.post("/users/register", json=user)
+
+        statuses = {}
+        queue = asyncio.Queue()
+        for _ in range(logins):
+            queue.put_nowait(None)
+
+        async def worker():
+            while not queue.empty():
+                queue.get_nowait()
+                response = await client.post("/users/token", data=form)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+
+    ok = statuses.get(200, 0)
+    return {"clients": clients, "logins": logins, "seconds": round(elapsed, 3),
+            "logins_per_s": round(ok / elapsed, 1), "statuses": statuses}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="login throughput against the password hashing pool")
+    parser.add_argument("--url", help="benchmark /users/token on a running server instead of the pool alone")
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--out", help="write the results to this json file")
+    args = parser.parse_args()
+
+    if args.url:
+        results = asyncio.run(http_benchmark(args.url, args.clients, args.logins))
+    else:
+        results = asyncio.run(hashing_benchmark(args.logins))
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
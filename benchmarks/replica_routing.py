@@ -0,0 +1,97 @@
+# Checks read routing with two local databases standing in for primary and replica.
+#
+# Both get the schema, and each a product the other does not have, so every response
+# shows which database served it:
+#   python -m benchmarks.replica_routing                       # two sqlite files
+#   python -m benchmarks.replica_routing --primary postgresql://localhost/primary \
+#       --replica postgresql://localhost/replica
+import argparse
+import os
+import secrets
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import create_engine, insert
+
+from benchmarks.run import start_server, wait_until_ready
+
+
+def prepare(url: str, product_name: str):
+    import models
+    engine = create_engine(url)
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(insert(models.Product).values(
+            name=product_name, description="routing check", price=1.0, quantity=10, available=10))
+    engine.dispose()
+
+
+def listed(client: httpx.Client):
+    response = client.get("/products/product_list", params={"limit": 100})
+    response.raise_for_status()
+    return {item["name"] for item in response.json()["items"]}
+
+
+def check(condition: bool, message: str):
+    print(f"{'ok  ' if condition else 'FAIL'} {message}")
+    return condition
+
+
+def main():
+    parser = argparse.ArgumentParser(description="read replica routing check")
+    parser.add_argument("--primary", help="sync URL of the primary, a sqlite file by default")
+    parser.add_argument("--replica", help="sync URL of the replica, a sqlite file by default")
+    parser.add_argument("--port", type=int, default=8767)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        primary = args.primary or f"sqlite:///{os.path.join(workdir, 'primary.db')}"
+        replica = args.replica or f"sqlite:///{os.path.join(workdir, 'replica.db')}"
+        marker = f"routing-{int(time.time())}"
+        admin_token = secrets.token_urlsafe(16)
+        prepare(primary, f"{marker}-primary")
+        prepare(replica, f"{marker}-replica")
+
+        env = {
+            **os.environ,
+            "DATABASE_URL": primary,
+            "ASYNC_DATABASE_URL": primary.replace("sqlite://", "sqlite+aiosqlite://", 1),
+            "DATABASE_REPLICA_URLS": replica.replace("sqlite://", "sqlite+aiosqlite://", 1),
+            "READ_YOUR_WRITES_SECONDS": "2",
+            "ORDER_WORKER_ENABLED": "false",
+            "ADMIN_TOKEN": admin_token,
+        }
+        url = f"http://127.0.0.1:{args.port}"
+        server = start_server(env, args.port, workers=1)
+        passed = True
+        try:
+            wait_until_ready(url, server)
+            with httpx.Client(base_url=url, timeout=10) as client:
+                names = listed(client)
+                passed &= check(f"{marker}-replica" in names, "reads go to the replica")
+
+                response = client.post("/products/create-product", json={
+                    "name": f"{marker}-written", "description": "routing check", "price": 2.0, "quantity": 1})
+                response.raise_for_status()
+                names = listed(client)
+                passed &= check(f"{marker}-written" in names, "a client that just wrote reads its write")
+
+                time.sleep(2.5)
+                names = listed(client)
+                passed &= check(f"{marker}-replica" in names, "the pin expires and reads go back to the replica")
+
+                with httpx.Client(base_url=url, timeout=10) as other:
+                    passed &= check(f"{marker}-replica" in listed(other), "other clients are not pinned")
+
+                print(client.get("/admin/pool", headers={"X-Admin-Token": admin_token}).json()["replicas"])
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    if not passed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
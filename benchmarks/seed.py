@@ -0,0 +1,62 @@
+# Seeds a benchmark dataset straight into the database: users, products and carts.
+#
+# Every run uses its own name prefix, so seeding never collides with existing rows.
+import random
+import uuid
+
+from sqlalchemy import insert, select
+
+BENCH_PASSWORD = "bench-password"
+
+
+def seed(users: int, products: int, items_per_cart: int, stock: int = 1_000_000, seed_value: int = 42):
+    # imported here so the runner can point DATABASE_URL at the benchmark database first
+    import database
+    import models
+    from security import pwd_context
+
+    rng = random.Random(seed_value)
+    prefix = f"bench-{uuid.uuid4().hex[:8]}"
+    models.Base.metadata.create_all(bind=database.init_sync_engine())
+
+    # one bcrypt hash for everybody, hashing each user would dominate the seeding time
+    password_hash = pwd_context.hash(BENCH_PASSWORD)
+    usernames = [f"{prefix}-user-{i}" for i in range(users)]
+    product_names = [f"{prefix}-product-{i}" for i in range(products)]
+
+    with database.SessionLocal() as db:
+        db.execute(insert(models.User), [
+            {"username": name, "email": f"{name}@example.com", "full_name": name, "password_hash": password_hash}
+            for name in usernames
+        ])
+        db.execute(insert(models.Product), [
+            {"name": name, "description": f"benchmark product {i}", "price": round(rng.uniform(1, 500), 2),
+             "quantity": stock, "available": stock}
+            for i, name in enumerate(product_names)
+        ])
+        user_ids = db.execute(
+            select(models.User.user_id).where(models.User.username.in_(usernames))
+        ).scalars().all()
+        product_ids = db.execute(
+            select(models.Product.product_id).where(models.Product.name.in_(product_names))
+        ).scalars().all()
+
+        db.execute(insert(models.Cart), [{"user_id": user_id} for user_id in user_ids])
+        cart_ids = db.execute(
+            select(models.Cart.cart_id).where(models.Cart.user_id.in_(user_ids))
+        ).scalars().all()
+
+        lines = []
+        for cart_id in cart_ids:
+            for product_id in rng.sample(product_ids, min(items_per_cart, len(product_ids))):
+                lines.append({"cart_id": cart_id, "product_id": product_id, "quantity": rng.randint(1, 3)})
+        if lines:
+            db.execute(insert(models.CartItem), lines)
+        db.commit()
+
+    return {
+        "prefix": prefix,
+        "usernames": usernames,
+        "product_names": product_names,
+        "password": BENCH_PASSWORD,
+    }
@@ -0,0 +1,84 @@
+# Cost of turning a product page into JSON, per 1,000 products.
+#
+# "before" is the old product_list path: ORM instances validated through the response
+# model, jsonable_encoder and json.dumps. "after" is the fast path: fetched rows written
+# by the precompiled TypeAdapter, and orjson (when installed) for plain content.
+#   python -m benchmarks.serialization --products 1000 --repeat 200
+import argparse
+import json
+import statistics
+import time
+from collections import namedtuple
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+import models
+from schemas.product import ProductPage
+from serialization import FastJSONResponse, dumps, orjson, product_page_serializer
+
+ProductTuple = namedtuple("ProductTuple", ["product_id", "name", "description", "price", "quantity", "available"])
+
+response_model_adapter = TypeAdapter(ProductPage)
+
+
+def make_rows(count: int):
+    return [
+        ProductTuple(i, f"product-{i}", f"description of product {i}", round(1 + i * 0.37, 2), i % 500, i % 250)
+        for i in range(1, count + 1)
+    ]
+
+
+def before(rows):
+    items = [
+        models.Product(product_id=row.product_id, name=row.name, description=row.description,
+                       price=row.price, quantity=row.quantity, available=row.available)
+        for row in rows
+    ]
+    page = response_model_adapter.validate_python({"items": items, "next_cursor": "abc"}, from_attributes=True)
+    content = jsonable_encoder(response_model_adapter.dump_python(page, mode="json"))
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def after(rows):
+    page = {"items": [row._asdict() for row in rows], "next_cursor": "abc"}
+    return FastJSONResponse(product_page_serializer.dump_json(page)).body
+
+
+def after_plain(rows):
+    return dumps({"items": [row._asdict() for row in rows], "next_cursor": "abc"})
+
+
+def measure(function, rows, repeat: int):
+    function(rows)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(rows)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serialization cost of a product page")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    rows = make_rows(args.products)
+    assert json.loads(before(rows)) == json.loads(after(rows)), "both paths must produce the same document"
+
+    scale = 1000 / args.products
+    results = {
+        "products": args.products,
+        "orjson": orjson is not None,
+        "before_ms_per_1000": round(measure(before, rows, args.repeat) * 1000 * scale, 3),
+        "after_ms_per_1000": round(measure(after, rows, args.repeat) * 1000 * scale, 3),
+        "after_plain_ms_per_1000": round(measure(after_plain, rows, args.repeat) * 1000 * scale, 3),
+    }
+    results["speedup"] = round(results["before_ms_per_1000"] / results["after_ms_per_1000"], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
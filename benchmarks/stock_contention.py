@@ -0,0 +1,110 @@
+# Hundreds of clients buying the same product at once, checks that stock is never oversold.
+#
+#   python -m benchmarks.stock_contention --url http://127.0.0.1:8000 --clients 200 --stock 1000
+#
+# Every client gets its own user and cart, then adds one unit at a time until the
+# server answers 406 (sold out). Units in carts plus stock left must equal the stock
+# the product started with.
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+
+# admission control may turn setup requests away while hundreds arrive at once, those are retried;
+# any other failure stops the run, a client without a cart would skew the counts
+async def post_until_admitted(client: httpx.AsyncClient, path: str, attempts: int = 20, **kwargs):
+    for attempt in range(attempts):
+        response = await client.post(path, **kwargs)
+        if response.status_code not in (429, 503):
+            break
+        await asyncio.sleep(float(response.headers.get("Retry-After", 0)) or 0.05 * (attempt + 1))
+    response.raise_for_status()
+    return response
+
+
+async def setup_client(client: httpx.AsyncClient, run_id: str, number: int):
+    username = f"contention-{run_id}-{number}"
+    await post_until_admitted(client, "/users/register", json={
+        "username": username,
+        "email": f"{username}@example.com",
+        "full_name": f"Contention {number}",
+        "password": "secret",
+    })
+    await post_until_admitted(client, "/carts/new-cart", params={"your_name": username})
+    return username
+
+
+async def buyer(client: httpx.AsyncClient, username: str, product: str, counts: dict):
+    while True:
+        response = await client.post(
+            "/carts/add-item",
+            params={"user_name": username},
+            json={"product_name": product, "quantity": 1},
+        )
+        counts["requests"] += 1
+        if response.status_code == 200:
+            counts["reserved"] += 1
+        elif response.status_code == 406:
+            return
+        else:
+            counts["errors"] += 1
+            if counts["errors"] > 100:
+                return
+
+
+async def run(url: str, clients: int, stock: int):
+    run_id = uuid.uuid4().hex[:8]
+    product = f"contention-{run_id}"
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        response = await client.post("/products/create-product", json={
+            "name": product, "description": "contention benchmark", "price": 1.0, "quantity": stock,
+        })
+        response.raise_for_status()
+
+        usernames = await asyncio.gather(*(setup_client(client, run_id, i) for i in range(clients)))
+
+        counts = {"requests": 0, "reserved": 0, "errors": 0}
+        start = time.perf_counter()
+        await asyncio.gather(*(buyer(client, username, product, counts) for username in usernames))
+        elapsed = time.perf_counter() - start
+
+        # stock that no cart holds, the reservations came out of it
+        left = (await client.get(f"/products/products/{product}")).json()["available"]
+
+    return {
+        "clients": clients,
+        "initial_stock": stock,
+        "reserved": counts["reserved"],
+        "stock_left": left,
+        "oversold": counts["reserved"] + left != stock or left < 0,
+        "errors": counts["errors"],
+        "seconds": round(elapsed, 3),
+        "requests_per_s": round(counts["requests"] / elapsed, 1),
+        "reservations_per_s": round(counts["reserved"] / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="concurrent add-item calls on a single product")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--stock", type=int, default=1000)
+    parser.add_argument("--out", help="write the results to this json file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.url, args.clients, args.stock))
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if results["oversold"]:
+        raise SystemExit("stock was oversold")
+
+
+if __name__ == "__main__":
+    main()
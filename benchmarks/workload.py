@@ -0,0 +1,117 @@
+# Mixed marketplace traffic: browsing, cart changes, checkout and logins.
+import asyncio
+import random
+import time
+
+import httpx
+
+from benchmarks.latency import summarize
+
+# share of each action in the mix
+DEFAULT_MIX = {
+    "browse": 50,
+    "view_items": 20,
+    "add_item": 15,
+    "login": 10,
+    "checkout": 5,
+}
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.statuses = {}
+        self.errors = {}
+
+    def record(self, endpoint: str, status: int | None, elapsed: float):
+        self.statuses.setdefault(endpoint, {})
+        key = str(status) if status is not None else "error"
+        self.statuses[endpoint][key] = self.statuses[endpoint].get(key, 0) + 1
+        if status is None or status >= 500:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        else:
+            self.samples.setdefault(endpoint, []).append(elapsed * 1000)
+
+    def report(self, elapsed: float):
+        endpoints = sorted(set(self.samples) | set(self.errors))
+        return {
+            endpoint: {
+                **summarize(self.samples.get(endpoint, []), self.errors.get(endpoint, 0), elapsed),
+                "statuses": self.statuses.get(endpoint, {}),
+            }
+            for endpoint in endpoints
+        }
+
+
+async def timed(recorder: Recorder, endpoint: str, request):
+    start = time.perf_counter()
+    try:
+        response = await request
+        status = response.status_code
+    except httpx.HTTPError:
+        response, status = None, None
+    recorder.record(endpoint, status, time.perf_counter() - start)
+    return response
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, dataset: dict, rng: random.Random, recorder: Recorder):
+        self.client = client
+        self.dataset = dataset
+        self.rng = rng
+        self.recorder = recorder
+        self.username = rng.choice(dataset["usernames"])
+        self.cursor = None
+
+    async def browse(self):
+        params = {"limit": 50}
+        if self.cursor:
+            params["cursor"] = self.cursor
+        response = await timed(self.recorder, "product_list", self.client.get("/products/product_list", params=params))
+        if response is not None and response.status_code == 200:
+            # walk the catalog page by page, start over at the end
+            self.cursor = response.json().get("next_cursor")
+
+    async def view_items(self):
+        await timed(self.recorder, "view-items", self.client.get(
+            "/carts/view-items", params={"username": self.username}))
+
+    async def add_item(self):
+        product = self.rng.choice(self.dataset["product_names"])
+        await timed(self.recorder, "add-item", self.client.post(
+            "/carts/add-item", params={"user_name": self.username},
+            json={"product_name": product, "quantity": 1}))
+
+    async def login(self):
+        await timed(self.recorder, "token", self.client.post(
+            "/users/token", data={"username": self.username, "password": self.dataset["password"]}))
+
+    async def checkout(self):
+        await timed(self.recorder, "checkout", self.client.post(
+            "/transactions/checkout", params={"username": self.username}))
+
+    async def run(self, mix: dict, deadline: float):
+        actions = list(mix)
+        weights = [mix[action] for action in actions]
+        while time.perf_counter() < deadline:
+            action = self.rng.choices(actions, weights)[0]
+            await getattr(self, action)()
+
+
+async def run_workload(url: str, dataset: dict, clients: int, duration: float, mix: dict = None, seed_value: int = 7):
+    mix = mix or DEFAULT_MIX
+    recorder = Recorder()
+    rng = random.Random(seed_value)
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        users = [VirtualUser(client, dataset, random.Random(rng.random()), recorder) for _ in range(clients)]
+        start = time.perf_counter()
+        await asyncio.gather(*(user.run(mix, start + duration) for user in users))
+        elapsed = time.perf_counter() - start
+
+    endpoints = recorder.report(elapsed)
+    every = [sample for samples in recorder.samples.values() for sample in samples]
+    return {
+        "total": summarize(every, sum(recorder.errors.values()), elapsed),
+        "endpoints": endpoints,
+    }
@@ -0,0 +1,105 @@
+import time
+from collections import OrderedDict
+
+
+# in-process LRU cache whose entries also expire after ttl seconds
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+# cache backends are async so a shared one (redis, memcached) can be dropped in for several workers
+class CacheBackend:
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value):
+        raise NotImplementedError
+
+    async def delete(self, *keys):
+        raise NotImplementedError
+
+    async def clear(self):
+        raise NotImplementedError
+
+    async def stats(self):
+        raise NotImplementedError
+
+
+# per worker backend on top of TTLCache
+class MemoryCacheBackend(CacheBackend):
+    def __init__(self, maxsize: int, ttl: float):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def set(self, key, value):
+        self.cache.set(key, value)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.cache.delete(key)
+
+    async def clear(self):
+        self.cache.clear()
+
+    async def stats(self):
+        return {"backend": "memory", **self.cache.stats()}
+
+
+CACHE_BACKENDS = {
+    "memory": MemoryCacheBackend,
+}
+
+
+def create_cache(backend: str, maxsize: int, ttl: float):
+    if backend not in CACHE_BACKENDS:
+        raise ValueError(f"Unknown cache backend {backend}, expected one of {', '.join(CACHE_BACKENDS)}")
+    return CACHE_BACKENDS[backend](maxsize=maxsize, ttl=ttl)
@@ -0,0 +1,29 @@
+import os
+
+from cache import create_cache
+from schemas.cart import CartOwner
+
+
+CART_CACHE_SIZE = int(os.getenv("CART_CACHE_SIZE", "10000"))
+# a cart deleted through another worker can still be resolved for this many seconds,
+# writes to it then fail with a 404; 0 turns the cache off
+CART_CACHE_TTL = float(os.getenv("CART_CACHE_TTL", "5"))
+
+cart_cache = create_cache("memory", maxsize=CART_CACHE_SIZE if CART_CACHE_TTL > 0 else 0, ttl=CART_CACHE_TTL)
+
+
+def owner_key(username: str):
+    return f"cart:user:{username}"
+
+
+async def get_cached_cart(username: str):
+    return await cart_cache.get(owner_key(username))
+
+
+async def cache_cart(owner: CartOwner):
+    await cart_cache.set(owner_key(owner.username), owner)
+
+
+# forget the cart of these users, called when a cart is created or deleted or a user renamed
+async def invalidate_cart(*usernames: str):
+    await cart_cache.delete(*(owner_key(username) for username in usernames))
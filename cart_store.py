@@ -0,0 +1,353 @@
+# Where cart lines live between requests.
+#
+# "database" writes every change to cart_items in the request's transaction.
+# "memory" keeps active carts in the worker and writes changed lines behind, in batches,
+# every CART_FLUSH_INTERVAL seconds; checkout flushes the cart first. Stock is taken and
+# released in SQL either way, so concurrent buyers still cannot oversell. The memory store
+# owns its carts, so it needs a single worker or requests routed to workers by user.
+import asyncio
+import contextlib
+import logging
+import os
+import time
+import weakref
+from collections import OrderedDict
+
+from sqlalchemy import select, delete, tuple_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from database import AsyncSessionLocal, insert_for
+from product_cache import get_cached_product_by_name
+
+logger = logging.getLogger(__name__)
+
+CART_STORE = os.getenv("CART_STORE", "database")
+# most carts held by the memory store, clean ones are evicted first
+CART_STORE_SIZE = int(os.getenv("CART_STORE_SIZE", "100000"))
+CART_FLUSH_INTERVAL = float(os.getenv("CART_FLUSH_INTERVAL", "1"))
+# changed lines written per statement
+CART_FLUSH_BATCH = int(os.getenv("CART_FLUSH_BATCH", "1000"))
+
+
+class CartStore:
+    write_behind = False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    # product_id -> quantity of every line in the cart
+    async def quantities(self, cart_id: int, db: AsyncSession):
+        raise NotImplementedError
+
+    # change lines by these deltas and commit the session with them; returns the new quantities
+    async def commit(self, cart_id: int, deltas: dict[int, int], db: AsyncSession):
+        raise NotImplementedError
+
+    # remove a line, returns (product_id, quantity) or None; the caller commits or calls restore
+    async def take(self, cart_id: int, product_name: str, db: AsyncSession):
+        raise NotImplementedError
+
+    async def restore(self, cart_id: int, product_id: int, quantity: int):
+        pass
+
+    # held around checkout: the cart in the database is complete and nothing changes it meanwhile
+    @contextlib.asynccontextmanager
+    async def checkout(self, cart_id: int):
+        yield
+
+    # forget a cart that was deleted
+    async def discard(self, cart_id: int):
+        pass
+
+    # the cart is in use and has lines the database may not have yet
+    def held(self, cart_id: int):
+        return False
+
+    def stats(self):
+        return {"backend": "database"}
+
+
+class DatabaseCartStore(CartStore):
+    async def quantities(self, cart_id: int, db: AsyncSession):
+        result = await db.execute(
+            select(models.CartItem.product_id, models.CartItem.quantity)
+            .where(models.CartItem.cart_id == cart_id)
+            .order_by(models.CartItem.cart_item_id)
+        )
+        return dict(result.all())
+
+    async def commit(self, cart_id: int, deltas: dict[int, int], db: AsyncSession):
+        # lines change by deltas, so a concurrent change of the same line is not lost
+        statement = insert_for(db, models.CartItem).values([
+            {"cart_id": cart_id, "product_id": product_id, "quantity": change}
+            for product_id, change in deltas.items()
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=[models.CartItem.cart_id, models.CartItem.product_id],
+            set_={"quantity": models.CartItem.quantity + statement.excluded.quantity},
+        ).returning(models.CartItem.product_id, models.CartItem.quantity)
+        result = await db.execute(statement)
+        lines = dict(result.all())
+
+        emptied = [product_id for product_id, quantity in lines.items() if quantity <= 0]
+        if emptied:
+            await db.execute(
+                delete(models.CartItem)
+                .where(models.CartItem.cart_id == cart_id, models.CartItem.product_id.in_(emptied))
+                .execution_options(synchronize_session=False)
+            )
+        await db.commit()
+        return lines
+
+    async def take(self, cart_id: int, product_name: str, db: AsyncSession):
+        product_id = select(models.Product.product_id).where(models.Product.name == product_name).scalar_subquery()
+        result = await db.execute(
+            delete(models.CartItem)
+            .where(models.CartItem.cart_id == cart_id, models.CartItem.product_id == product_id)
+            .returning(models.CartItem.product_id, models.CartItem.quantity)
+        )
+        return result.first()
+
+
+class MemoryCartStore(CartStore):
+    write_behind = True
+
+    def __init__(self, maxsize: int = CART_STORE_SIZE, flush_interval: float = CART_FLUSH_INTERVAL,
+                 batch_size: int = CART_FLUSH_BATCH):
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # cart_id -> {product_id: quantity}, least recently used first
+        self.carts = OrderedDict()
+        # cart_id -> product ids changed since the last flush
+        self.dirty = {}
+        self.locks = weakref.WeakValueDictionary()
+        self.flush_lock = asyncio.Lock()
+        # carts whose lines are being written, kept in memory until the write is done
+        self.flushing = set()
+        self.task = None
+        self.flushes = 0
+        self.lines_written = 0
+        self.changes = 0
+        self.errors = 0
+        self.last_flush_seconds = 0.0
+
+    def lock(self, cart_id: int):
+        lock = self.locks.get(cart_id)
+        if lock is None:
+            lock = self.locks[cart_id] = asyncio.Lock()
+        return lock
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    # nothing buffered is lost on a clean shutdown
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except (SQLAlchemyError, OSError):
+                self.errors += 1
+                logger.exception("cart flush failed, the changes are kept for the next one")
+
+    async def load(self, cart_id: int):
+        cart = self.carts.get(cart_id)
+        if cart is not None:
+            self.carts.move_to_end(cart_id)
+            return cart
+        # always from the primary, a replica may not have the last flush yet
+        async with AsyncSessionLocal() as primary:
+            result = await primary.execute(
+                select(models.CartItem.product_id, models.CartItem.quantity)
+                .where(models.CartItem.cart_id == cart_id)
+                .order_by(models.CartItem.cart_item_id)
+            )
+            lines = dict(result.all())
+        # another request may have loaded it while this one waited
+        cart = self.carts.setdefault(cart_id, lines)
+        self.evict()
+        return cart
+
+    def evict(self):
+        if len(self.carts) <= self.maxsize:
+            return
+        for cart_id in list(self.carts):
+            if len(self.carts) <= self.maxsize:
+                break
+            if cart_id not in self.dirty and cart_id not in self.flushing:
+                del self.carts[cart_id]
+
+    def mark(self, cart_id: int, product_ids):
+        self.dirty.setdefault(cart_id, set()).update(product_ids)
+        self.changes += 1
+
+    async def quantities(self, cart_id: int, db: AsyncSession):
+        return dict(await self.load(cart_id))
+
+    async def commit(self, cart_id: int, deltas: dict[int, int], db: AsyncSession):
+        async with self.lock(cart_id):
+            # the stock change is committed first, the cart only follows a successful one
+            await db.commit()
+            # no await between loading and changing it, so it cannot be evicted in between
+            cart = await self.load(cart_id)
+            lines = {}
+            for product_id, change in deltas.items():
+                quantity = cart.get(product_id, 0) + change
+                if quantity > 0:
+                    cart[product_id] = quantity
+                else:
+                    cart.pop(product_id, None)
+                lines[product_id] = quantity
+            self.mark(cart_id, deltas)
+            return lines
+
+    async def take(self, cart_id: int, product_name: str, db: AsyncSession):
+        product = await get_cached_product_by_name(db, product_name)
+        if product is None:
+            return None
+        async with self.lock(cart_id):
+            cart = await self.load(cart_id)
+            quantity = cart.pop(product.product_id, None)
+            if quantity is None:
+                return None
+            self.mark(cart_id, [product.product_id])
+            return product.product_id, quantity
+
+    async def restore(self, cart_id: int, product_id: int, quantity: int):
+        cart = self.carts.get(cart_id)
+        if cart is not None:
+            cart[product_id] = cart.get(product_id, 0) + quantity
+            self.mark(cart_id, [product_id])
+
+    @contextlib.asynccontextmanager
+    async def checkout(self, cart_id: int):
+        async with self.lock(cart_id):
+            await self.flush(cart_id)
+            yield
+            # the order took the lines, the next request reads the emptied cart again
+            self.carts.pop(cart_id, None)
+
+    async def discard(self, cart_id: int):
+        async with self.lock(cart_id):
+            self.carts.pop(cart_id, None)
+            self.dirty.pop(cart_id, None)
+
+    def held(self, cart_id: int):
+        return cart_id in self.carts
+
+    # write the changed lines of one cart, or of every cart
+    async def flush(self, cart_id: int | None = None):
+        # one flush at a time, so a checkout waits for a background write of its cart
+        async with self.flush_lock:
+            if cart_id is not None:
+                changed = {cart_id: self.dirty.pop(cart_id)} if cart_id in self.dirty else {}
+            else:
+                changed, self.dirty = self.dirty, {}
+            if not changed:
+                return 0
+
+            # quantities as they are now, later changes mark the lines dirty again
+            lines = [
+                (cart, product_id, self.carts.get(cart, {}).get(product_id, 0))
+                for cart, product_ids in changed.items() for product_id in product_ids
+            ]
+            start = time.perf_counter()
+            written = 0
+            self.flushing = set(changed)
+            try:
+                for offset in range(0, len(lines), self.batch_size):
+                    written += await self.write(lines[offset:offset + self.batch_size])
+            except (SQLAlchemyError, OSError):
+                # written again on the next flush
+                for cart, product_ids in changed.items():
+                    if cart in self.carts:
+                        self.dirty.setdefault(cart, set()).update(product_ids)
+                raise
+            finally:
+                self.flushing = set()
+            self.flushes += 1
+            self.lines_written += written
+            self.last_flush_seconds = time.perf_counter() - start
+            return written
+
+    async def write(self, lines: list[tuple[int, int, int]]):
+        upserts = [
+            {"cart_id": cart_id, "product_id": product_id, "quantity": quantity}
+            for cart_id, product_id, quantity in lines if quantity > 0
+        ]
+        removals = [(cart_id, product_id) for cart_id, product_id, quantity in lines if quantity <= 0]
+
+        async with AsyncSessionLocal() as db:
+            try:
+                if removals:
+                    await db.execute(
+                        delete(models.CartItem)
+                        .where(tuple_(models.CartItem.cart_id, models.CartItem.product_id).in_(removals))
+                        .execution_options(synchronize_session=False)
+                    )
+                if upserts:
+                    statement = insert_for(db, models.CartItem).values(upserts)
+                    statement = statement.on_conflict_do_update(
+                        index_elements=[models.CartItem.cart_id, models.CartItem.product_id],
+                        set_={"quantity": statement.excluded.quantity},
+                    )
+                    await db.execute(statement)
+                await db.commit()
+            except IntegrityError:
+                await db.rollback()
+                cart_ids = list(dict.fromkeys(cart_id for cart_id, _, _ in lines))
+                if len(cart_ids) == 1:
+                    # the cart was deleted behind the store, its lines have nowhere to go
+                    self.carts.pop(cart_ids[0], None)
+                    self.errors += 1
+                    return 0
+                # find the deleted carts by writing one cart at a time
+                written = 0
+                for cart_id in cart_ids:
+                    written += await self.write([line for line in lines if line[0] == cart_id])
+                return written
+        return len(lines)
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "carts": len(self.carts),
+            "dirty_carts": len(self.dirty),
+            "changes": self.changes,
+            "flushes": self.flushes,
+            "lines_written": self.lines_written,
+            "errors": self.errors,
+            "last_flush_ms": round(self.last_flush_seconds * 1000, 3),
+        }
+
+
+CART_STORES = {
+    "database": DatabaseCartStore,
+    "memory": MemoryCartStore,
+}
+
+
+def create_cart_store(backend: str):
+    if backend not in CART_STORES:
+        raise ValueError(f"Unknown cart store {backend}, expected one of {', '.join(CART_STORES)}")
+    return CART_STORES[backend]()
+
+
+cart_store = create_cart_store(CART_STORE)
@@ -0,0 +1,71 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response, status
+
+# clients and CDNs may store catalog responses but must revalidate them, which costs a 304
+CATALOG_CACHE_CONTROL = os.getenv("CATALOG_CACHE_CONTROL", "no-cache")
+
+
+# strong validators: the same product version always renders the same body
+def product_etag(product_id: int, version: int):
+    return f'"p{product_id}.{version}"'
+
+
+def page_etag(versions):
+    digest = hashlib.blake2b(digest_size=16)
+    for product_id, version in versions:
+        digest.update(f"{product_id}.{version},".encode())
+    return f'"l{digest.hexdigest()}"'
+
+
+# timestamps are stored as naive UTC
+def http_date(value: datetime):
+    return format_datetime(value.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+
+
+def parse_http_date(value: str | None):
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def etag_matches(header: str, etag: str):
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in header.split(","))
+
+
+def is_conditional(request: Request):
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+
+# If-None-Match wins over If-Modified-Since when a client sends both
+def not_modified(request: Request, etag: str, last_modified: datetime | None = None):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if last_modified is None:
+        return False
+    since = parse_http_date(request.headers.get("if-modified-since"))
+    return since is not None and last_modified.replace(microsecond=0) <= since
+
+
+def validator_headers(etag: str, last_modified: datetime | None = None):
+    headers = {"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def not_modified_response(headers: dict):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
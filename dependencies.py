@@ -0,0 +1,26 @@
+from fastapi import Request
+
+from database import SessionLocal, AsyncSessionLocal, init_sync_engine
+from replicas import replica_set
+
+
+# Database dependency
+def get_db():
+    init_sync_engine()
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Async database dependency, does not block the event loop while waiting on postgres
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# read-only endpoints: a healthy replica unless the client wrote moments ago
+async def get_read_db(request: Request):
+    async with replica_set.sessions_for(request.cookies)() as db:
+        yield db
@@ -0,0 +1,144 @@
+import os
+import secrets
+
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+
+from admission import admission_stats
+from cart_cache import cart_cache
+from cart_store import cart_store
+from database import pool_status
+from metrics import registry, Counter, Gauge
+from product_cache import product_cache
+from replicas import replica_set
+from routers.users import user_cache, auth_stats
+from workers.carts import cart_sweeper
+from workers.orders import order_worker
+from workers.reservations import reservation_expirer
+
+# shared secret operators send as X-Admin-Token; unset, the admin endpoints answer 403
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+# the endpoints show replica URLs and internal counters, they are not for clients
+async def require_admin(x_admin_token: str | None = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin token required")
+
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get("/pool", description="Connection pool usage of this worker, used to size the pool")
+async def get_pool_status():
+    return {**pool_status(), "replicas": replica_set.stats()}
+
+
+@router.get("/admission", description="Requests admitted and turned away by route class in this worker")
+async def get_admission_stats():
+    return admission_stats()
+
+
+@router.get("/cache", description="Hit and miss counters of the in-process caches")
+async def get_cache_stats():
+    return {
+        "users": {**user_cache.stats(), **auth_stats},
+        "products": await product_cache.stats(),
+        "carts": await cart_cache.stats(),
+    }
+
+
+@router.get("/workers", description="Progress of the background workers in this process")
+async def get_worker_stats():
+    return {
+        "orders": order_worker.stats(),
+        "carts": cart_store.stats(),
+        "cart_sweeper": cart_sweeper.stats(),
+        "reservations": reservation_expirer.stats(),
+    }
+
+
+pool_connections = registry.register(Gauge(
+    "db_pool_connections", "Pooled connections by state.", ("state",)))
+pool_waits = registry.register(Counter(
+    "db_pool_waits_total", "Connections handed out by the pool."))
+pool_wait_time = registry.register(Counter(
+    "db_pool_wait_seconds_total", "Time spent waiting for a pooled connection."))
+pool_timeouts = registry.register(Counter(
+    "db_pool_timeouts_total", "Requests that gave up waiting for a connection."))
+cache_requests = registry.register(Counter(
+    "cache_requests_total", "Cache lookups by result.", ("cache", "result")))
+cache_evictions = registry.register(Counter(
+    "cache_evictions_total", "Entries evicted to stay within the size bound.", ("cache",)))
+cache_entries = registry.register(Gauge(
+    "cache_entries", "Entries held by the cache.", ("cache",)))
+replica_healthy = registry.register(Gauge(
+    "db_replica_healthy", "1 while the replica is in rotation.", ("replica",)))
+db_reads = registry.register(Counter(
+    "db_reads_total", "Read-only requests by the database they were sent to.", ("target",)))
+admission_in_flight = registry.register(Gauge(
+    "admission_in_flight", "Admitted requests being handled, by route class.", ("route_class",)))
+admission_rejected = registry.register(Counter(
+    "admission_rejected_total", "Requests turned away before reaching a route.", ("route_class", "reason")))
+pool_recent_wait = registry.register(Gauge(
+    "db_pool_recent_wait_seconds", "Moving average of recent waits for a pooled connection."))
+worker_items = registry.register(Counter(
+    "worker_items_total", "Items processed by the background workers, by outcome.", ("worker", "outcome")))
+
+cart_sweeps = registry.register(Counter(
+    "cart_sweeps_total", "Completed passes of the abandoned cart sweeper."))
+cart_sweep_duration = registry.register(Gauge(
+    "cart_sweep_last_duration_seconds", "Duration of the last abandoned cart sweep."))
+
+
+# the stats above, copied into the prometheus metrics on every scrape
+async def collect_runtime_stats():
+    pool = pool_status()
+    for state in ("checked_out", "idle", "overflow"):
+        if state in pool:
+            pool_connections.set(state, value=pool[state])
+    pool_waits.set(value=pool["wait"]["count"])
+    pool_wait_time.set(value=pool["wait"]["total_ms"] / 1000)
+    pool_timeouts.set(value=pool["wait"]["timeouts"])
+    pool_recent_wait.set(value=pool["wait"]["recent_ms"] / 1000)
+
+    for name, route_class in admission_stats()["classes"].items():
+        admission_in_flight.set(name, value=route_class["in_flight"])
+        for reason, count in route_class["rejected"].items():
+            admission_rejected.set(name, reason, value=count)
+
+    caches = {
+        "users": user_cache.stats(),
+        "products": await product_cache.stats(),
+        "carts": await cart_cache.stats(),
+    }
+    for name, stats in caches.items():
+        cache_requests.set(name, "hit", value=stats["hits"])
+        cache_requests.set(name, "miss", value=stats["misses"])
+        cache_evictions.set(name, value=stats["evictions"])
+        cache_entries.set(name, value=stats["size"])
+
+    replicas = replica_set.stats()
+    db_reads.set("primary", value=replicas["primary_reads"])
+    for index, replica in enumerate(replicas["replicas"]):
+        replica_healthy.set(f"replica-{index}", value=int(replica["healthy"]))
+        db_reads.set(f"replica-{index}", value=replica["reads"])
+
+    orders = order_worker.stats()
+    worker_items.set("orders", "completed", value=orders["completed"])
+    worker_items.set("orders", "failed", value=orders["failed"])
+    carts = cart_store.stats()
+    if carts["backend"] == "memory":
+        worker_items.set("cart_flush", "written", value=carts["lines_written"])
+        worker_items.set("cart_flush", "failed", value=carts["errors"])
+    sweeper = cart_sweeper.stats()
+    for outcome in ("carts_deleted", "lines_deleted", "orphans_deleted", "units_returned", "errors"):
+        worker_items.set("cart_sweeper", outcome, value=sweeper[outcome])
+    cart_sweeps.set(value=sweeper["sweeps"])
+    reservations = reservation_expirer.stats()
+    worker_items.set("reservation_expiry", "released", value=reservations["released"])
+    worker_items.set("reservation_expiry", "units_released", value=reservations["units_released"])
+    worker_items.set("reservation_expiry", "errors", value=reservations["errors"])
+    cart_sweep_duration.set(value=sweeper["last_sweep_ms"] / 1000)
+
+
+registry.collectors.append(collect_runtime_stats)
@@ -1,10 +1,70 @@
+import logging
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
-from routers import users, products, carts, transactions
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.exc import SQLAlchemyError
+
+from admission import AdmissionMiddleware
+from cart_store import cart_store
+from database import init_engines, dispose_engines, warm_pool, POOL_WARMUP
+from internal import admin
+from metrics import MetricsMiddleware, instrument_engine, registry
+from replicas import ReadYourWritesMiddleware, replica_set
+from routers import users, products, carts, transactions, health
+from workers.carts import cart_sweeper, CART_SWEEPER_ENABLED
+from workers.orders import order_worker, ORDER_WORKER_ENABLED
+from workers.reservations import reservation_expirer, RESERVATION_EXPIRY_ENABLED
+
+logger = logging.getLogger(__name__)
+
 
-app = FastAPI()
+# the engine and its pool belong to the running app, not to the import of this module
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    instrument_engine(init_engines())
+    if POOL_WARMUP:
+        try:
+            await warm_pool(POOL_WARMUP)
+        except (SQLAlchemyError, OSError):
+            # not fatal, readiness reports the database until it answers
+            logger.warning("could not warm up the connection pool", exc_info=True)
+    # replicas that do not answer yet stay out of rotation, reads go to the primary meanwhile
+    await replica_set.start()
+    await cart_store.start()
+    if ORDER_WORKER_ENABLED:
+        order_worker.start()
+    if CART_SWEEPER_ENABLED:
+        cart_sweeper.start()
+    if RESERVATION_EXPIRY_ENABLED:
+        reservation_expirer.start()
+    health.state["ready"] = True
+    yield
+    health.state["ready"] = False
+    await reservation_expirer.stop()
+    await cart_sweeper.stop()
+    await order_worker.stop()
+    # writes out every cart still held in memory
+    await cart_store.stop()
+    await replica_set.stop()
+    await dispose_engines()
+
+
+app = FastAPI(lifespan=lifespan)
+# innermost, so rejected requests still show up in the request metrics
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 
 app.include_router(users.router, prefix="/users", tags=["users"])
 app.include_router(products.router, prefix="/products", tags=["products"])
 app.include_router(carts.router, prefix="/carts", tags=["carts"])
 app.include_router(transactions.router, prefix="/transactions", tags=["transactions"])
+app.include_router(admin.router, prefix="/admin", tags=["admin"])
+app.include_router(health.router, prefix="/health", tags=["health"])
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return PlainTextResponse(await registry.render(), media_type="text/plain; version=0.0.4")
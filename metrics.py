@@ -0,0 +1,211 @@
+# Request and SQL metrics in the Prometheus text format, without a client library.
+#
+# MetricsMiddleware times every request by route template, and the engine hooks
+# count the statements each request runs and the time spent in them.
+import bisect
+import contextvars
+import logging
+import os
+import time
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# requests slower than this many milliseconds are logged with their SQL, unset to disable
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0")) or None
+# statements kept per slow request
+SLOW_REQUEST_MAX_STATEMENTS = 50
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    # totals kept by another module, copied in at scrape time
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., +Inf count, sum]
+        self.values = {}
+
+    def observe(self, *label_values, value: float):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for label_values, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket", format_labels(self.labels + ("le",), label_values + (le,)), cumulative
+            yield f"{self.name}_count", format_labels(self.labels, label_values), cumulative
+            yield f"{self.name}_sum", format_labels(self.labels, label_values), series[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # coroutines run at scrape time to refresh gauges owned by other modules
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    async def render(self):
+        for collect in self.collectors:
+            await collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "http_requests_total", "Requests by route and status code.", ("method", "route", "status")))
+http_latency = registry.register(Histogram(
+    "http_request_duration_seconds", "Request latency by route.", ("method", "route")))
+http_in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "Requests being handled right now."))
+db_queries = registry.register(Counter(
+    "db_queries_total", "SQL statements run, by route.", ("route",)))
+db_time = registry.register(Counter(
+    "db_query_seconds_total", "Time spent in SQL statements, by route.", ("route",)))
+db_queries_per_request = registry.register(Histogram(
+    "http_request_db_queries", "SQL statements per request, by route.", ("route",), buckets=QUERY_BUCKETS))
+
+
+# SQL activity of the request being handled
+class RequestStats:
+    def __init__(self, keep_statements: bool):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.statements = [] if keep_statements else None
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = current_request.get()
+    if stats is None:
+        # background workers, startup
+        db_queries.inc("background")
+        db_time.inc("background", amount=elapsed)
+        return
+    stats.queries += 1
+    stats.db_seconds += elapsed
+    if stats.statements is not None and len(stats.statements) < SLOW_REQUEST_MAX_STATEMENTS:
+        stats.statements.append((elapsed, statement))
+
+
+def instrument_engine(engine):
+    # the async engine fires its events on the sync engine it wraps
+    sync_engine = getattr(engine, "sync_engine", engine)
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(keep_statements=SLOW_REQUEST_MS is not None)
+        token = current_request.set(stats)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_in_flight.dec()
+            current_request.reset(token)
+            # the route template keeps label cardinality bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            http_requests.inc(method, route, status_code)
+            http_latency.observe(method, route, value=elapsed)
+            db_queries.inc(route, amount=stats.queries)
+            db_time.inc(route, amount=stats.db_seconds)
+            db_queries_per_request.observe(route, value=stats.queries)
+            if SLOW_REQUEST_MS is not None and elapsed * 1000 >= SLOW_REQUEST_MS:
+                log_slow_request(method, route, status_code, elapsed, stats)
+
+
+def log_slow_request(method: str, route: str, status_code: int, elapsed: float, stats: RequestStats):
+    statements = "\n".join(
+        f"  {seconds * 1000:8.2f} ms  {' '.join(statement.split())}" for seconds, statement in stats.statements
+    )
+    logger.warning(
+        "slow request %s %s -> %s in %.1f ms, %d queries, %.1f ms in the database\n%s",
+        method, route, status_code, elapsed * 1000, stats.queries, stats.db_seconds * 1000, statements,
+    )
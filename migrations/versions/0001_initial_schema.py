@@ -0,0 +1,79 @@
+"""initial schema
+
+The tables as create_all used to build them at import time. Databases
+created that way are marked as migrated with `alembic stamp 0001`.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "users",
+        sa.Column("user_id", sa.Integer(), primary_key=True),
+        sa.Column("username", sa.String(50)),
+        sa.Column("email", sa.String(100), unique=True),
+        sa.Column("full_name", sa.String()),
+        sa.Column("password_hash", sa.String(100)),
+    )
+    op.create_index("ix_users_user_id", "users", ["user_id"])
+
+    op.create_table(
+        "user_profiles",
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.user_id"), primary_key=True),
+    )
+
+    op.create_table(
+        "products",
+        sa.Column("product_id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(100)),
+        sa.Column("description", sa.String()),
+        sa.Column("price", sa.Float(precision=2)),
+        sa.Column("quantity", sa.Integer()),
+    )
+    op.create_index("ix_products_product_id", "products", ["product_id"])
+
+    op.create_table(
+        "carts",
+        sa.Column("cart_id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.user_id")),
+        sa.Column("created_at", sa.DateTime(), server_default=sa.func.now()),
+    )
+    op.create_index("ix_carts_cart_id", "carts", ["cart_id"])
+
+    op.create_table(
+        "cart_items",
+        sa.Column("cart_item_id", sa.Integer(), primary_key=True),
+        sa.Column("cart_id", sa.Integer(), sa.ForeignKey("carts.cart_id")),
+        sa.Column("product_id", sa.Integer(), sa.ForeignKey("products.product_id")),
+        sa.Column("quantity", sa.Integer()),
+    )
+    op.create_index("ix_cart_items_cart_item_id", "cart_items", ["cart_item_id"])
+
+    op.create_table(
+        "transactions",
+        sa.Column("transaction_id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.user_id")),
+        sa.Column("status", sa.String(20)),
+    )
+    op.create_index("ix_transactions_transaction_id", "transactions", ["transaction_id"])
+
+
+def downgrade():
+    op.drop_table("transactions")
+    op.drop_table("cart_items")
+    op.drop_table("carts")
+    op.drop_table("products")
+    op.drop_table("user_profiles")
+    op.drop_table("users")
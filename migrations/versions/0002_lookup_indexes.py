@@ -0,0 +1,90 @@
+"""indexes on the lookup columns
+
+Handlers filter by username, product name, cart owner and the
+(cart_id, product_id) pair, none of which were indexed.
+
+Nothing kept usernames or product names unique until now, while logins
+and product lookups expect one row per name and the bulk import upserts
+on product name. A repeated name is kept by its oldest user or product,
+the others get their id appended.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:10:00
+
+"""
+from alembic import op
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # older code could add a product to a cart twice, fold those lines into one
+    op.execute("""
+        UPDATE cart_items SET quantity = duplicates.total
+        FROM (
+            SELECT min(cart_item_id) AS keep_id, sum(quantity) AS total
+            FROM cart_items
+            GROUP BY cart_id, product_id
+            HAVING count(*) > 1
+        ) AS duplicates
+        WHERE cart_items.cart_item_id = duplicates.keep_id
+    """)
+    op.execute("""
+        DELETE FROM cart_items
+        WHERE cart_item_id IN (
+            SELECT cart_item_id FROM (
+                SELECT cart_item_id,
+                       row_number() OVER (PARTITION BY cart_id, product_id ORDER BY cart_item_id) AS position
+                FROM cart_items
+            ) AS numbered
+            WHERE position > 1
+        )
+    """)
+
+    op.execute("""
+        UPDATE users SET username = substr(username, 1, 38) || ' #' || user_id
+        WHERE user_id IN (
+            SELECT user_id FROM (
+                SELECT user_id,
+                       row_number() OVER (PARTITION BY username ORDER BY user_id) AS position
+                FROM users
+                WHERE username IS NOT NULL
+            ) AS numbered
+            WHERE position > 1
+        )
+    """)
+    op.execute("""
+        UPDATE products SET name = substr(name, 1, 88) || ' #' || product_id
+        WHERE product_id IN (
+            SELECT product_id FROM (
+                SELECT product_id,
+                       row_number() OVER (PARTITION BY name ORDER BY product_id) AS position
+                FROM products
+                WHERE name IS NOT NULL
+            ) AS numbered
+            WHERE position > 1
+        )
+    """)
+
+    op.create_index("ix_users_username", "users", ["username"], unique=True)
+    op.create_index("ix_products_name", "products", ["name"], unique=True)
+    op.create_index("ix_products_price_product_id", "products", ["price", "product_id"])
+    op.create_index("ix_carts_user_id", "carts", ["user_id"])
+    op.create_index("ix_cart_items_cart_id_product_id", "cart_items", ["cart_id", "product_id"], unique=True)
+    op.create_index("ix_cart_items_product_id", "cart_items", ["product_id"])
+    op.create_index("ix_transactions_user_id", "transactions", ["user_id"])
+
+
+def downgrade():
+    op.drop_index("ix_transactions_user_id", table_name="transactions")
+    op.drop_index("ix_cart_items_product_id", table_name="cart_items")
+    op.drop_index("ix_cart_items_cart_id_product_id", table_name="cart_items")
+    op.drop_index("ix_carts_user_id", table_name="carts")
+    op.drop_index("ix_products_price_product_id", table_name="products")
+    op.drop_index("ix_products_name", table_name="products")
+    op.drop_index("ix_users_username", table_name="users")
@@ -0,0 +1,47 @@
+"""order pipeline
+
+Checkout persists orders: transactions get a total and timestamps, and
+the cart lines are copied into transaction_lines.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 12:20:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("transactions", sa.Column("total_amount", sa.Float(precision=2)))
+    op.add_column("transactions", sa.Column("created_at", sa.DateTime(), server_default=sa.func.now()))
+    op.add_column("transactions", sa.Column("updated_at", sa.DateTime()))
+    op.add_column("transactions", sa.Column("failure_reason", sa.String()))
+    op.create_index("ix_transactions_status_transaction_id", "transactions", ["status", "transaction_id"])
+
+    op.create_table(
+        "transaction_lines",
+        sa.Column("line_id", sa.Integer(), primary_key=True),
+        sa.Column("transaction_id", sa.Integer(), sa.ForeignKey("transactions.transaction_id")),
+        sa.Column("product_id", sa.Integer(), sa.ForeignKey("products.product_id")),
+        sa.Column("product_name", sa.String(100)),
+        sa.Column("quantity", sa.Integer()),
+        sa.Column("unit_price", sa.Float(precision=2)),
+    )
+    op.create_index("ix_transaction_lines_transaction_id", "transaction_lines", ["transaction_id"])
+
+
+def downgrade():
+    op.drop_index("ix_transaction_lines_transaction_id", table_name="transaction_lines")
+    op.drop_table("transaction_lines")
+    op.drop_index("ix_transactions_status_transaction_id", table_name="transactions")
+    op.drop_column("transactions", "failure_reason")
+    op.drop_column("transactions", "updated_at")
+    op.drop_column("transactions", "created_at")
+    op.drop_column("transactions", "total_amount")
@@ -0,0 +1,31 @@
+"""product versions
+
+Every write to a product bumps version and updated_at, which catalog
+responses turn into ETag and Last-Modified headers. Existing rows start
+at version 1, modified now.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 13:10:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("products", sa.Column("version", sa.Integer(), nullable=False, server_default="1"))
+    # the application writes UTC, postgres now() is in the server time zone
+    now = sa.text("(now() at time zone 'utc')") if op.get_bind().dialect.name == "postgresql" else sa.func.now()
+    op.add_column("products", sa.Column("updated_at", sa.DateTime(), server_default=now))
+
+
+def downgrade():
+    op.drop_column("products", "updated_at")
+    op.drop_column("products", "version")
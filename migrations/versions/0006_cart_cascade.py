@@ -0,0 +1,37 @@
+"""cart cascade
+
+Deleting a cart deletes its lines, and an index on carts(created_at,
+cart_id) lets the cart sweeper walk abandoned carts oldest first. Lines
+already left without a cart keep their stock until the sweeper returns
+it. SQLite does not enforce foreign keys by default, so there only the
+index is added and the ORM cascade deletes the lines.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 14:20:00
+
+"""
+from alembic import op
+
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_carts_created_at_cart_id", "carts", ["created_at", "cart_id"])
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.drop_constraint("cart_items_cart_id_fkey", "cart_items", type_="foreignkey")
+    op.create_foreign_key(
+        "cart_items_cart_id_fkey", "cart_items", "carts", ["cart_id"], ["cart_id"], ondelete="CASCADE"
+    )
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "postgresql":
+        op.drop_constraint("cart_items_cart_id_fkey", "cart_items", type_="foreignkey")
+        op.create_foreign_key("cart_items_cart_id_fkey", "cart_items", "carts", ["cart_id"], ["cart_id"])
+    op.drop_index("ix_carts_created_at_cart_id", table_name="carts")
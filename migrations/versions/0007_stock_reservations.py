@@ -0,0 +1,70 @@
+"""stock reservations
+
+Carts hold stock with expiring rows in stock_reservations instead of
+taking it from products.quantity, which becomes the stock on hand.
+products.available keeps on hand minus reserved.
+
+Until now quantity already had every cart line taken out of it. That
+figure becomes available, each cart line becomes a reservation that
+expires in 30 minutes, and the lines go back into quantity.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 15:05:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "stock_reservations",
+        sa.Column("reservation_id", sa.Integer(), primary_key=True),
+        sa.Column("cart_id", sa.Integer(), sa.ForeignKey("carts.cart_id"), nullable=False),
+        sa.Column("product_id", sa.Integer(), sa.ForeignKey("products.product_id"), nullable=False),
+        sa.Column("quantity", sa.Integer(), nullable=False),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index(
+        "ix_stock_reservations_cart_id_product_id", "stock_reservations", ["cart_id", "product_id"], unique=True
+    )
+    op.create_index("ix_stock_reservations_product_id", "stock_reservations", ["product_id"])
+    op.create_index("ix_stock_reservations_expires_at", "stock_reservations", ["expires_at"])
+    op.add_column("products", sa.Column("available", sa.Integer(), server_default="0"))
+
+    # the application writes UTC
+    if op.get_bind().dialect.name == "postgresql":
+        expires = "(now() at time zone 'utc') + interval '30 minutes'"
+    else:
+        expires = "datetime('now', '+30 minutes')"
+    op.execute("UPDATE products SET available = quantity")
+    op.execute(f"""
+        INSERT INTO stock_reservations (cart_id, product_id, quantity, expires_at)
+        SELECT cart_id, product_id, quantity, {expires}
+        FROM cart_items
+        WHERE cart_id IS NOT NULL AND product_id IS NOT NULL AND quantity > 0
+    """)
+    op.execute("""
+        UPDATE products SET quantity = quantity + (
+            SELECT sum(stock_reservations.quantity) FROM stock_reservations
+            WHERE stock_reservations.product_id = products.product_id
+        )
+        WHERE product_id IN (SELECT product_id FROM stock_reservations)
+    """)
+
+
+def downgrade():
+    # reserved stock is taken out of quantity again
+    op.execute("UPDATE products SET quantity = available")
+    op.drop_column("products", "available")
+    op.drop_index("ix_stock_reservations_expires_at", table_name="stock_reservations")
+    op.drop_index("ix_stock_reservations_product_id", table_name="stock_reservations")
+    op.drop_index("ix_stock_reservations_cart_id_product_id", table_name="stock_reservations")
+    op.drop_table("stock_reservations")
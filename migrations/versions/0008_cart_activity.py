@@ -0,0 +1,34 @@
+"""cart activity
+
+carts.updated_at records the last change to a cart, so the cart
+sweeper deletes carts nobody touched for a while instead of every cart
+created long ago. Existing carts start from their creation time. The
+sweeper walks carts by (updated_at, cart_id), which replaces the
+(created_at, cart_id) index.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 16:10:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("carts", sa.Column("updated_at", sa.DateTime(), server_default=sa.func.now()))
+    op.execute("UPDATE carts SET updated_at = created_at WHERE created_at IS NOT NULL")
+    op.create_index("ix_carts_updated_at_cart_id", "carts", ["updated_at", "cart_id"])
+    op.drop_index("ix_carts_created_at_cart_id", table_name="carts")
+
+
+def downgrade():
+    op.create_index("ix_carts_created_at_cart_id", "carts", ["created_at", "cart_id"])
+    op.drop_index("ix_carts_updated_at_cart_id", table_name="carts")
+    op.drop_column("carts", "updated_at")
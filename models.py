@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, func, DateTime
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, func, DateTime, Index
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -8,7 +10,7 @@ class User(Base):
     __tablename__ = 'users'
 
     user_id = Column(Integer, primary_key=True, index=True)
-    username = Column(String(50))
+    username = Column(String(50), unique=True, index=True)
     email = Column(String(100), unique=True)
     full_name = Column(String)
     password_hash = Column(String(100))
@@ -34,46 +36,119 @@ class Product(Base):
     __tablename__ = 'products'
 
     product_id = Column(Integer, primary_key=True, index=True)
-    name = Column(String(100))
+    name = Column(String(100), unique=True, index=True)
     description = Column(String)
     price = Column(Float(precision=2))
+    # stock on hand, sold stock leaves it at checkout
     quantity = Column(Integer)
+    # on hand minus reserved; every insert sets it to the stock on hand
+    available = Column(Integer, server_default="0")
+    # bumped by every write, catalog ETags and Last-Modified come from these
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime, default=datetime.utcnow, server_default=func.now())
 
     # Add other product-related fields here
 
     cart_items = relationship("CartItem", back_populates="product")
 
+    __table_args__ = (
+        # keyset pagination ordered by price
+        Index("ix_products_price_product_id", "price", "product_id"),
+    )
+
+
+# values for every UPDATE of products, so conditional requests see the change
+def product_version_bump():
+    return {"version": Product.version + 1, "updated_at": datetime.utcnow()}
+
 
 class Cart(Base):
     __tablename__ = 'carts'
 
     cart_id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.user_id'))
+    user_id = Column(Integer, ForeignKey('users.user_id'), index=True)
     created_at = Column(DateTime, server_default=func.now())
+    # last change to the cart, written by the database clock like created_at
+    updated_at = Column(DateTime, server_default=func.now())
 
     user = relationship("User", back_populates="carts")
-    cart_items = relationship("CartItem", back_populates="cart")
+    # the database deletes the lines with the cart, the session does not load them first
+    cart_items = relationship("CartItem", back_populates="cart", cascade="all, delete-orphan", passive_deletes=True)
+
+    __table_args__ = (
+        # the cart sweeper walks abandoned carts least recently changed first
+        Index("ix_carts_updated_at_cart_id", "updated_at", "cart_id"),
+    )
 
 
 class CartItem(Base):
     __tablename__ = 'cart_items'
 
     cart_item_id = Column(Integer, primary_key=True, index=True)
-    cart_id = Column(Integer, ForeignKey('carts.cart_id'))
-    product_id = Column(Integer, ForeignKey('products.product_id'))
+    cart_id = Column(Integer, ForeignKey('carts.cart_id', ondelete="CASCADE"))
+    product_id = Column(Integer, ForeignKey('products.product_id'), index=True)
     quantity = Column(Integer)
 
     cart = relationship("Cart", back_populates="cart_items")
     product = relationship("Product", back_populates="cart_items")
 
+    __table_args__ = (
+        # a product appears once per cart, also serves lookups by cart_id alone
+        Index("ix_cart_items_cart_id_product_id", "cart_id", "product_id", unique=True),
+    )
+
+
+# stock a cart holds until it expires, see reservations.py
+class StockReservation(Base):
+    __tablename__ = 'stock_reservations'
+
+    reservation_id = Column(Integer, primary_key=True)
+    # no cascade: a cart is deleted after its holds are released, or the stock would be lost
+    cart_id = Column(Integer, ForeignKey('carts.cart_id'), nullable=False)
+    product_id = Column(Integer, ForeignKey('products.product_id'), nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        # one hold per product and cart, also serves lookups by cart_id alone
+        Index("ix_stock_reservations_cart_id_product_id", "cart_id", "product_id", unique=True),
+        # the expiry job releases the oldest holds first
+        Index("ix_stock_reservations_expires_at", "expires_at"),
+    )
+
 
 class Transaction(Base):
     __tablename__ = 'transactions'
 
     transaction_id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.user_id'))
+    user_id = Column(Integer, ForeignKey('users.user_id'), index=True)
     status = Column(String(20))
+    total_amount = Column(Float(precision=2))
+    created_at = Column(DateTime, server_default=func.now())
+    # set by the app, the order worker compares it against its own clock
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    failure_reason = Column(String)
 
     # Add other transaction-related fields here
 
     user = relationship("User", back_populates="transactions")
+    lines = relationship("TransactionLine", back_populates="transaction")
+
+    __table_args__ = (
+        # the order worker claims pending orders oldest first
+        Index("ix_transactions_status_transaction_id", "status", "transaction_id"),
+    )
+
+
+# a cart line as it was at checkout
+class TransactionLine(Base):
+    __tablename__ = 'transaction_lines'
+
+    line_id = Column(Integer, primary_key=True)
+    transaction_id = Column(Integer, ForeignKey('transactions.transaction_id'), index=True)
+    product_id = Column(Integer, ForeignKey('products.product_id'))
+    product_name = Column(String(100))
+    quantity = Column(Integer)
+    unit_price = Column(Float(precision=2))
+
+    transaction = relationship("Transaction", back_populates="lines")
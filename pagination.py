@@ -0,0 +1,32 @@
+import base64
+import binascii
+import json
+
+from fastapi import HTTPException, status
+
+
+# opaque keyset cursor: the sort key of the last row on a page, tied to the ordering it was made for
+def encode_cursor(order_by: str, *values):
+    raw = json.dumps([order_by, *values], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def is_key_value(value):
+    return isinstance(value, (int, float, str)) and not isinstance(value, bool)
+
+
+# the `size` values of the sort key, a cursor that encode_cursor did not make is rejected
+def decode_cursor(cursor: str, order_by: str, size: int):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_order, *values = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    if cursor_order != order_by:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Cursor was made for ordering by {cursor_order}, not {order_by}"
+        )
+    if len(values) != size or not all(is_key_value(value) for value in values):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return values
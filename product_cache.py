@@ -0,0 +1,82 @@
+import asyncio
+import os
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from cache import create_cache
+from replicas import replica_set, REPLICA_MAX_LAG, REPLICA_CHECK_INTERVAL
+from schemas.product import CachedProduct
+
+
+PRODUCT_CACHE_BACKEND = os.getenv("PRODUCT_CACHE_BACKEND", "memory")
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "10000"))
+# stock levels shown from the cache can lag by up to this many seconds,
+# stock checks on cart changes always read the row itself
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "30"))
+
+product_cache = create_cache(PRODUCT_CACHE_BACKEND, maxsize=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL)
+# delayed invalidations still to run, referenced so they are not collected
+pending_invalidations = set()
+
+
+def name_key(name: str):
+    return f"product:name:{name}"
+
+
+def id_key(product_id: int):
+    return f"product:id:{product_id}"
+
+
+async def cache_product(product: CachedProduct):
+    await product_cache.set(name_key(product.name), product)
+    await product_cache.set(id_key(product.product_id), product)
+
+
+async def load_product(db: AsyncSession, *criteria):
+    result = await db.execute(select(models.Product).where(*criteria))
+    row = result.scalars().first()
+    if row is None:
+        return None
+    product = CachedProduct.model_validate(row, from_attributes=True)
+    await cache_product(product)
+    return product
+
+
+# cached snapshot only, None on a miss
+async def peek_cached_product_by_name(name: str):
+    return await product_cache.get(name_key(name))
+
+
+# read-through lookups, None when the product does not exist
+async def get_cached_product_by_name(db: AsyncSession, name: str):
+    product = await product_cache.get(name_key(name))
+    if product is None:
+        product = await load_product(db, models.Product.name == name)
+    return product
+
+
+async def get_cached_product_by_id(db: AsyncSession, product_id: int):
+    product = await product_cache.get(id_key(product_id))
+    if product is None:
+        product = await load_product(db, models.Product.product_id == product_id)
+    return product
+
+
+# drop the cached entries of a product, called after it is created, changed or deleted
+async def invalidate_product(*names: str, product_id: int | None = None):
+    keys = [name_key(name) for name in names]
+    if product_id is not None:
+        keys.append(id_key(product_id))
+    await product_cache.delete(*keys)
+    if replica_set.enabled:
+        # a replica that has not replayed the write yet can put the old row back in the cache
+        task = asyncio.create_task(invalidate_later(keys, REPLICA_MAX_LAG + REPLICA_CHECK_INTERVAL))
+        pending_invalidations.add(task)
+        task.add_done_callback(pending_invalidations.discard)
+
+
+async def invalidate_later(keys: list[str], delay: float):
+    await asyncio.sleep(delay)
+    await product_cache.delete(*keys)
@@ -0,0 +1,52 @@
+import csv
+import io
+import json
+
+from sqlalchemy import select
+
+import models
+from database import AsyncSessionLocal
+
+# rows fetched per round trip from the server-side cursor
+EXPORT_BATCH_SIZE = 2000
+
+EXPORT_COLUMNS = (
+    models.Product.product_id,
+    models.Product.name,
+    models.Product.description,
+    models.Product.price,
+    models.Product.quantity,
+)
+EXPORT_FIELDS = [column.key for column in EXPORT_COLUMNS]
+
+
+def ndjson_chunk(rows):
+    return "".join(json.dumps(dict(row._mapping)) + "\n" for row in rows)
+
+
+def csv_chunk(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def csv_header():
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(EXPORT_FIELDS)
+    return buffer.getvalue()
+
+
+# streams the products table as it is read, memory use does not depend on the table size
+async def export_products(format: str):
+    # own session: the request dependency is closed before a streamed body is sent
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(
+            select(*EXPORT_COLUMNS)
+            .order_by(models.Product.product_id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        if format == "csv":
+            yield csv_header()
+        serialize = csv_chunk if format == "csv" else ndjson_chunk
+        async for rows in result.partitions():
+            yield serialize(rows)
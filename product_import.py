@@ -0,0 +1,186 @@
+import csv
+import io
+import json
+
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from database import insert_for
+from product_cache import invalidate_product
+from schemas.product import ProductCreate
+
+# row errors kept per batch in the report
+MAX_ERRORS_PER_BATCH = 50
+INVALID_UTF8 = "invalid utf-8"
+
+
+def decode_line(line: bytes):
+    try:
+        return line.decode("utf-8").rstrip("\r")
+    except UnicodeDecodeError:
+        return None
+
+
+# split a streamed body into lines without holding more than one chunk in memory;
+# a line that is not utf-8 comes out as None and fails as a row of its own
+async def stream_lines(chunks):
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield decode_line(line)
+    if buffer:
+        yield decode_line(buffer)
+
+
+# (line number, dict or error message) for each record of an NDJSON body
+async def ndjson_records(lines):
+    number = 0
+    async for line in lines:
+        number += 1
+        if line is None:
+            yield number, INVALID_UTF8
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield number, f"invalid json: {exc}"
+            continue
+        if not isinstance(record, dict):
+            yield number, "expected a json object"
+            continue
+        yield number, record
+
+
+# same for a CSV body with a header row, quoted fields may span lines
+async def csv_records(lines):
+    header = None
+    pending = []
+    number = 0
+    first_line = 0
+    async for line in lines:
+        number += 1
+        if line is None:
+            # the record it belongs to is lost, it may have started on an earlier line
+            yield (first_line if pending else number), INVALID_UTF8
+            pending = []
+            continue
+        if not pending:
+            first_line = number
+        pending.append(line)
+        text = "\n".join(pending)
+        # an odd number of quotes means a quoted field continues on the next line
+        if text.count('"') % 2:
+            continue
+        pending = []
+        if not text.strip():
+            continue
+        row = next(csv.reader(io.StringIO(text)))
+        if header is None:
+            header = [name.strip() for name in row]
+            continue
+        if len(row) != len(header):
+            yield first_line, f"expected {len(header)} fields, got {len(row)}"
+            continue
+        yield first_line, dict(zip(header, row))
+    if pending:
+        yield first_line, "unterminated quoted field"
+
+
+def format_validation_error(exc: ValidationError):
+    return "; ".join(
+        f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in exc.errors()
+    )
+
+
+# upsert one batch on name, returns an error message when the batch could not be written
+async def write_batch(db: AsyncSession, products: dict[str, dict]):
+    statement = insert_for(db, models.Product).values(list(products.values()))
+    statement = statement.on_conflict_do_update(
+        index_elements=[models.Product.name],
+        set_={
+            "description": statement.excluded.description,
+            "price": statement.excluded.price,
+            "quantity": statement.excluded.quantity,
+            # reservations stay, the new stock on hand changes what is left for them
+            "available": models.Product.available + statement.excluded.quantity - models.Product.quantity,
+            **models.product_version_bump(),
+        },
+    ).returning(models.Product.product_id, models.Product.name)
+    try:
+        result = await db.execute(statement)
+        written = result.all()
+        await db.commit()
+    except SQLAlchemyError as exc:
+        await db.rollback()
+        return str(exc.orig if getattr(exc, "orig", None) is not None else exc).splitlines()[0]
+
+    for product_id, name in written:
+        await invalidate_product(name, product_id=product_id)
+    return None
+
+
+async def import_products(db: AsyncSession, records, batch_size: int):
+    report = {"rows": 0, "imported": 0, "failed": 0, "batches": []}
+    batch = None
+
+    async def flush():
+        if batch["products"]:
+            error = await write_batch(db, batch["products"])
+            if error:
+                # the whole batch was rolled back
+                batch["failed"] += len(batch["products"])
+                if len(batch["errors"]) < MAX_ERRORS_PER_BATCH:
+                    batch["errors"].append({"line": batch["first_line"], "error": f"batch not written: {error}"})
+            else:
+                batch["imported"] = len(batch["products"])
+        report["imported"] += batch["imported"]
+        report["failed"] += batch["failed"]
+        batch.pop("products")
+        batch.pop("size")
+        report["batches"].append(batch)
+
+    async for line, record in records:
+        if batch is None:
+            batch = {
+                "batch": len(report["batches"]) + 1, "first_line": line, "last_line": line,
+                "imported": 0, "failed": 0, "errors": [], "products": {}, "size": 0,
+            }
+        report["rows"] += 1
+        batch["last_line"] = line
+        batch["size"] += 1
+
+        if isinstance(record, str):
+            error = record
+        else:
+            try:
+                product = ProductCreate.model_validate(record)
+                error = None
+            except ValidationError as exc:
+                error = format_validation_error(exc)
+
+        if error:
+            batch["failed"] += 1
+            if len(batch["errors"]) < MAX_ERRORS_PER_BATCH:
+                batch["errors"].append({"line": line, "error": error})
+        else:
+            # ON CONFLICT cannot touch a row twice in one statement, the last row for a name wins
+            if product.name in batch["products"]:
+                batch["failed"] += 1
+                if len(batch["errors"]) < MAX_ERRORS_PER_BATCH:
+                    batch["errors"].append({"line": line, "error": f"{product.name} repeated in batch, later row kept"})
+            # a new product has all of its stock available
+            batch["products"][product.name] = {**product.model_dump(), "available": product.quantity}
+
+        if batch["size"] >= batch_size:
+            await flush()
+            batch = None
+
+    if batch is not None:
+        await flush()
+    return report
@@ -0,0 +1,77 @@
+import os
+
+from sqlalchemy import select, or_, and_, case, func, literal_column, Float
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from pagination import encode_cursor, decode_cursor
+
+# postgres: tsvector + pg_trgm, basic: plain LIKE matching for setups without those extensions
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND")
+SEARCH_LANGUAGE = os.getenv("SEARCH_LANGUAGE", "english")
+
+PRODUCT_COLUMNS = (
+    models.Product.product_id,
+    models.Product.name,
+    models.Product.description,
+    models.Product.price,
+    models.Product.quantity,
+    models.Product.available,
+)
+
+# generated column and GIN indexes live in migration 0004, not in the model, so the
+# model still works on databases without them
+search_vector = literal_column("products.search_vector", type_=TSVECTOR)
+
+
+def search_backend(db: AsyncSession):
+    if SEARCH_BACKEND:
+        return SEARCH_BACKEND
+    return "postgres" if db.bind.dialect.name == "postgresql" else "basic"
+
+
+# full text match on name and description, or a trigram match on the name for typos
+def postgres_matches(text: str):
+    query = func.websearch_to_tsquery(SEARCH_LANGUAGE, text)
+    rank = func.ts_rank(search_vector, query) + func.similarity(models.Product.name, text)
+    return (
+        select(*PRODUCT_COLUMNS, rank.cast(Float).label("rank"))
+        .where(or_(search_vector.op("@@")(query), models.Product.name.op("%")(text)))
+    )
+
+
+# every word must appear in the name or description, name matches rank first; no typo tolerance
+def basic_matches(text: str):
+    words = text.split() or [text]
+    conditions = [
+        or_(models.Product.name.ilike(f"%{word}%"), models.Product.description.ilike(f"%{word}%"))
+        for word in words
+    ]
+    rank = case((models.Product.name.ilike(f"%{text}%"), 1.0), else_=0.5)
+    return select(*PRODUCT_COLUMNS, rank.cast(Float).label("rank")).where(and_(*conditions))
+
+
+# ranked matches, best first, with keyset pagination over (rank, product_id)
+async def search_products(db: AsyncSession, text: str, limit: int, cursor: str | None = None):
+    if search_backend(db) == "postgres":
+        matches = postgres_matches(text).subquery()
+    else:
+        matches = basic_matches(text).subquery()
+
+    query = select(matches)
+    if cursor:
+        last_rank, last_id = decode_cursor(cursor, "search", 2)
+        query = query.where(or_(
+            matches.c.rank < last_rank,
+            and_(matches.c.rank == last_rank, matches.c.product_id > last_id),
+        ))
+    query = query.order_by(matches.c.rank.desc(), matches.c.product_id).limit(limit)
+
+    result = await db.execute(query)
+    rows = result.all()
+
+    next_cursor = None
+    if rows and len(rows) == limit:
+        next_cursor = encode_cursor("search", rows[-1].rank, rows[-1].product_id)
+    return {"items": [row._mapping for row in rows], "next_cursor": next_cursor}
@@ -0,0 +1,187 @@
+# Read replicas for the read-only endpoints.
+#
+# Replicas are picked round robin. A background check runs SELECT 1 (and reads the replay
+# lag on postgres) every few seconds, and takes failing or lagging replicas out of rotation
+# until they recover. With no healthy replica, reads go to the primary.
+#
+# A client that has just written is pinned to the primary for READ_YOUR_WRITES_SECONDS.
+# A cookie set on successful writes does it, so the pin holds across workers.
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from database import AsyncSessionLocal, PoolWaitStats, async_database_url, engine_options, engine_pool_status
+from metrics import instrument_engine
+
+logger = logging.getLogger(__name__)
+
+# comma separated, sync or asyncpg URLs; unset to read from the primary only
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+REPLICA_CHECK_TIMEOUT = float(os.getenv("REPLICA_CHECK_TIMEOUT", "2"))
+# replicas further behind than this many seconds are not read from
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+PIN_COOKIE = "primary_until"
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# 0 when caught up; a primary or a database without replication reports 0 as well
+POSTGRES_LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = async_database_url(url)
+        # waits for this replica's connections, apart from the primary's
+        self.wait_stats = PoolWaitStats()
+        self.engine = create_async_engine(self.url, **engine_options(is_async=True, wait_stats=self.wait_stats))
+        self.sessions = async_sessionmaker(self.engine, autoflush=False, expire_on_commit=False)
+        # out of rotation until the first check passes
+        self.healthy = False
+        self.lag_seconds = None
+        self.reads = 0
+        self.failed_checks = 0
+        self.last_error = None
+
+    async def check(self):
+        async with self.engine.connect() as connection:
+            if self.engine.dialect.name == "postgresql":
+                lag = (await connection.execute(POSTGRES_LAG_QUERY)).scalar()
+            else:
+                lag = (await connection.execute(text("SELECT 0"))).scalar()
+        return float(lag or 0)
+
+
+class ReplicaSet:
+    def __init__(self, urls: list[str] = DATABASE_REPLICA_URLS, check_interval: float = REPLICA_CHECK_INTERVAL):
+        self.urls = urls
+        self.check_interval = check_interval
+        self.replicas = []
+        self.rotation = itertools.count()
+        self.task = None
+        self.primary_reads = 0
+
+    @property
+    def enabled(self):
+        return bool(self.urls)
+
+    # engines are created with the primary one, in the app lifespan
+    async def start(self):
+        if not self.enabled or self.replicas:
+            return
+        self.replicas = [Replica(url) for url in self.urls]
+        for replica in self.replicas:
+            instrument_engine(replica.engine)
+        await self.check_all()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+        self.replicas = []
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.check_all()
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check_replica(replica) for replica in self.replicas))
+
+    async def check_replica(self, replica: Replica):
+        try:
+            lag = await asyncio.wait_for(replica.check(), REPLICA_CHECK_TIMEOUT)
+        except (asyncio.TimeoutError, SQLAlchemyError, OSError) as exc:
+            healthy, lag, replica.last_error = False, None, str(exc) or type(exc).__name__
+            replica.failed_checks += 1
+        else:
+            healthy = lag <= REPLICA_MAX_LAG
+            replica.last_error = None if healthy else f"{lag:.1f}s behind"
+        if healthy != replica.healthy:
+            logger.warning("replica %s is %s", replica.url.render_as_string(hide_password=True),
+                           "back in rotation" if healthy else f"out of rotation: {replica.last_error}")
+        replica.healthy = healthy
+        replica.lag_seconds = lag
+
+    def choose(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self.rotation) % len(healthy)]
+
+    # session factory for a read-only request
+    def sessions_for(self, cookies: dict):
+        if self.replicas and not pinned_to_primary(cookies):
+            replica = self.choose()
+            if replica is not None:
+                replica.reads += 1
+                return replica.sessions
+        self.primary_reads += 1
+        return AsyncSessionLocal
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "primary_reads": self.primary_reads,
+            "replicas": [
+                {
+                    "url": replica.url.render_as_string(hide_password=True),
+                    "healthy": replica.healthy,
+                    "lag_seconds": replica.lag_seconds,
+                    "reads": replica.reads,
+                    "failed_checks": replica.failed_checks,
+                    "last_error": replica.last_error,
+                    "pool": engine_pool_status(replica.engine, replica.wait_stats),
+                }
+                for replica in self.replicas
+            ],
+        }
+
+
+def pinned_to_primary(cookies: dict):
+    try:
+        return float(cookies.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+replica_set = ReplicaSet()
+
+
+# sets the pin cookie on every successful write
+class ReadYourWritesMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] in SAFE_METHODS
+                or not replica_set.enabled or READ_YOUR_WRITES_SECONDS <= 0):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                until = time.time() + READ_YOUR_WRITES_SECONDS
+                cookie = (f"{PIN_COOKIE}={until:.3f}; Max-Age={max(int(READ_YOUR_WRITES_SECONDS), 1)}; "
+                          f"Path=/; HttpOnly; SameSite=Lax")
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", cookie.encode())]}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
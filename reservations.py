@@ -0,0 +1,212 @@
+# Stock held for carts.
+#
+# Product.quantity is the stock on hand, sold stock leaves it at checkout. A cart holds
+# stock with a reservation row per product that expires RESERVATION_TTL_SECONDS after
+# the cart last changed it. Product.available is on hand minus every reservation, kept
+# up to date by each statement that changes a reservation, so reads need no aggregate
+# and a conditional UPDATE on it stops overselling. Expired reservations are released
+# by workers.reservations; a cart whose hold expired takes the stock again at checkout,
+# if it is still there.
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, case, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from database import insert_for
+
+RESERVATION_TTL_SECONDS = float(os.getenv("RESERVATION_TTL_SECONDS", "1800"))
+
+
+def expires_at():
+    return datetime.utcnow() + timedelta(seconds=RESERVATION_TTL_SECONDS)
+
+
+# every change to a cart goes through its reservations, so they record its last activity;
+# the cart row is locked before any product, in the same order as checkout locks them
+async def touch_cart(cart_id: int, db: AsyncSession):
+    await db.execute(
+        update(models.Cart)
+        .where(models.Cart.cart_id == cart_id)
+        .values(updated_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+
+
+# add to the reservations of a cart, refreshing their expiry
+async def hold(cart_id: int, quantities: dict[int, int], db: AsyncSession):
+    statement = insert_for(db, models.StockReservation).values([
+        {"cart_id": cart_id, "product_id": product_id, "quantity": quantity, "expires_at": expires_at()}
+        for product_id, quantity in quantities.items()
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=[models.StockReservation.cart_id, models.StockReservation.product_id],
+        set_={
+            "quantity": models.StockReservation.quantity + statement.excluded.quantity,
+            "expires_at": statement.excluded.expires_at,
+        },
+    )
+    await db.execute(statement)
+
+
+# take stock for one product by name, in the fewest statements; None when missing or short
+async def reserve_by_name(cart_id: int, product_name: str, quantity: int, db: AsyncSession):
+    await touch_cart(cart_id, db)
+    result = await db.execute(
+        update(models.Product)
+        .where(models.Product.name == product_name, models.Product.available >= quantity)
+        .values(available=models.Product.available - quantity, **models.product_version_bump())
+        .returning(models.Product.product_id)
+    )
+    product_id = result.scalar()
+    if product_id is not None:
+        await hold(cart_id, {product_id: quantity}, db)
+    return product_id
+
+
+# change the reservations of a cart by product_id -> delta; returns the products short of
+# stock, the caller rolls back when there are any and commits otherwise
+async def reserve(cart_id: int, deltas: dict[int, int], db: AsyncSession):
+    await touch_cart(cart_id, db)
+    result = await db.execute(
+        select(models.StockReservation.product_id, models.StockReservation.quantity)
+        .where(
+            models.StockReservation.cart_id == cart_id,
+            models.StockReservation.product_id.in_(list(deltas)),
+        )
+        .with_for_update()
+    )
+    held = dict(result.all())
+    # a release gives back at most what is still held, an expired hold was given back already
+    changes = {
+        product_id: delta if delta > 0 else -min(-delta, held.get(product_id, 0))
+        for product_id, delta in deltas.items()
+    }
+    changes = {product_id: change for product_id, change in changes.items() if change}
+    if not changes:
+        return []
+
+    # every product in one conditional update, releases always pass
+    change = case(changes, value=models.Product.product_id)
+    result = await db.execute(
+        update(models.Product)
+        .where(models.Product.product_id.in_(list(changes)), models.Product.available >= change)
+        .values(available=models.Product.available - change, **models.product_version_bump())
+        .returning(models.Product.product_id)
+        .execution_options(synchronize_session=False)
+    )
+    updated = set(result.scalars().all())
+    if len(updated) != len(changes):
+        return [product_id for product_id in changes if product_id not in updated]
+
+    await hold(cart_id, changes, db)
+    emptied = [product_id for product_id, change in changes.items() if held.get(product_id, 0) + change <= 0]
+    if emptied:
+        await db.execute(
+            delete(models.StockReservation)
+            .where(
+                models.StockReservation.cart_id == cart_id,
+                models.StockReservation.product_id.in_(emptied),
+            )
+            .execution_options(synchronize_session=False)
+        )
+    return []
+
+
+# product_id -> quantity made available again
+async def make_available(returned: dict[int, int], db: AsyncSession):
+    if not returned:
+        return
+    await db.execute(
+        update(models.Product)
+        .where(models.Product.product_id.in_(list(returned)))
+        .values(
+            available=models.Product.available + case(returned, value=models.Product.product_id),
+            **models.product_version_bump(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def sum_by_product(rows):
+    totals = {}
+    for product_id, quantity in rows:
+        if product_id is not None and quantity:
+            totals[product_id] = totals.get(product_id, 0) + quantity
+    return totals
+
+
+# drop every reservation of these carts and make their stock available; returns the units
+async def release_carts(cart_ids: list[int], db: AsyncSession):
+    result = await db.execute(
+        delete(models.StockReservation)
+        .where(models.StockReservation.cart_id.in_(cart_ids))
+        .returning(models.StockReservation.product_id, models.StockReservation.quantity)
+        .execution_options(synchronize_session=False)
+    )
+    returned = sum_by_product(result.all())
+    await make_available(returned, db)
+    return sum(returned.values())
+
+
+# bring the reservations of a cart in line with its lines before they are sold; returns
+# the products short of stock, whose hold expired and whose stock went to someone else
+async def settle(cart_id: int, db: AsyncSession):
+    result = await db.execute(
+        select(models.CartItem.product_id, models.CartItem.quantity).where(models.CartItem.cart_id == cart_id)
+    )
+    lines = dict(result.all())
+    # locked, so the expiry job cannot release a hold between here and the sale
+    result = await db.execute(
+        select(models.StockReservation.product_id, models.StockReservation.quantity)
+        .where(models.StockReservation.cart_id == cart_id)
+        .with_for_update()
+    )
+    held = dict(result.all())
+    deltas = {
+        product_id: lines.get(product_id, 0) - held.get(product_id, 0)
+        for product_id in lines.keys() | held.keys()
+        if lines.get(product_id, 0) != held.get(product_id, 0)
+    }
+    if not deltas:
+        return []
+    return await reserve(cart_id, deltas, db)
+
+
+# the held stock of a settled cart leaves the shelf, in one statement
+async def sell(cart_id: int, db: AsyncSession):
+    sold = (
+        delete(models.StockReservation)
+        .where(models.StockReservation.cart_id == cart_id)
+        .returning(models.StockReservation.product_id, models.StockReservation.quantity)
+    )
+    if db.bind.dialect.name == "sqlite":
+        # no data-modifying CTEs, the same in two statements
+        reserved = (
+            select(models.StockReservation.quantity)
+            .where(
+                models.StockReservation.cart_id == cart_id,
+                models.StockReservation.product_id == models.Product.product_id,
+            )
+            .scalar_subquery()
+        )
+        await db.execute(
+            update(models.Product)
+            .where(models.Product.product_id.in_(
+                select(models.StockReservation.product_id).where(models.StockReservation.cart_id == cart_id)
+            ))
+            .values(quantity=models.Product.quantity - reserved, **models.product_version_bump())
+            .execution_options(synchronize_session=False)
+        )
+        await db.execute(sold)
+        return
+
+    # WITH sold AS (DELETE ... RETURNING) UPDATE products ... FROM sold
+    sold = sold.cte("sold")
+    await db.execute(
+        update(models.Product)
+        .where(models.Product.product_id == sold.c.product_id)
+        .values(quantity=models.Product.quantity - sold.c.quantity, **models.product_version_bump())
+        .execution_options(synchronize_session=False)
+    )
@@ -1,9 +1,21 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from sqlalchemy.orm import Session
+from collections import namedtuple
+
+from fastapi import APIRouter, HTTPException, status, Depends, Query
+from sqlalchemy import select, func, and_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import models
-from routers.users import get_db
-from schemas.cart import Item
+from cart_cache import get_cached_cart, cache_cart, invalidate_cart
+from cart_store import cart_store
+from dependencies import get_async_db, get_read_db
+from routers.users import (
+    AUTH_TRUST_TOKEN_CLAIMS, auth_stats, credentials_exception, decode_access_token, optional_oauth2_scheme,
+)
+from schemas.cart import Item, ItemUpdate, CartOperation, CartBatch, CartOwner
+from reservations import reserve, reserve_by_name, touch_cart
+from serialization import FastJSONResponse, cart_lines_serializer
+from workers.carts import delete_carts
 
 router = APIRouter()
 
@@ -16,190 +28,317 @@ def not_found_404(details: str = "not found"):
     )
 
 
-# add new product to cart
-def add_to_cart(cart_id: int, product_id: int, quantity: int, db: Session):
-    new_item = models.CartItem(
-        cart_id=cart_id,
-        product_id=product_id,
-        quantity=quantity
+# apply add / set / remove operations to a cart with a fixed number of statements, whatever the count
+async def apply_cart_operations(cart_id: int, operations: list[CartOperation], db: AsyncSession):
+    names = list(dict.fromkeys(operation.product_name for operation in operations))
+
+    query = select(models.Product.product_id, models.Product.name, models.Product.available)
+    if not cart_store.write_behind:
+        # every product and its current line in the cart, one IN query
+        query = query.add_columns(func.coalesce(models.CartItem.quantity, 0).label("in_cart")).outerjoin(
+            models.CartItem, and_(
+                models.CartItem.product_id == models.Product.product_id,
+                models.CartItem.cart_id == cart_id,
+            )
+        )
+    result = await db.execute(query.where(models.Product.name.in_(names)))
+    products = {row.name: row for row in result.all()}
+    missing = [name for name in names if name not in products]
+    if missing:
+        raise not_found_404(details=f"Products do not exist: {', '.join(missing)}")
+
+    if cart_store.write_behind:
+        held = await cart_store.quantities(cart_id, db)
+        in_cart = {name: held.get(products[name].product_id, 0) for name in names}
+    else:
+        in_cart = {name: products[name].in_cart for name in names}
+
+    # fold the operations into the quantity each line should end with
+    targets = dict(in_cart)
+    for operation in operations:
+        if operation.op == "add":
+            targets[operation.product_name] += operation.quantity
+        elif operation.op == "set":
+            targets[operation.product_name] = operation.quantity
+        else:
+            targets[operation.product_name] = 0
+
+    # stock each line reserves (positive) or releases (negative)
+    deltas = {
+        products[name].product_id: target - in_cart[name]
+        for name, target in targets.items()
+        if target != in_cart[name]
+    }
+    if not deltas:
+        return {}
+
+    # any product short of stock fails the batch
+    short_ids = await reserve(cart_id, deltas, db)
+    if short_ids:
+        await db.rollback()
+        short = [
+            f"{name} ({products[name].available} left)"
+            for name in names if products[name].product_id in short_ids
+        ]
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail=f"Not much product at the moment: {', '.join(short)}"
+        )
+
+    # lines change by the same deltas, committed together with the stock
+    lines = await cart_store.commit(cart_id, deltas, db)
+
+    names_by_id = {products[name].product_id: name for name in names}
+    return {names_by_id[product_id]: max(quantity, 0) for product_id, quantity in lines.items()}
+
+
+async def get_user_by_name(username: str, db: AsyncSession):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalars().first()
+
+
+# user and cart of the request: from the token claims, the cache or one joined query
+async def get_current_cart(
+    token: str | None = Depends(optional_oauth2_scheme),
+    username: str | None = Query(None, description="Deprecated, send a bearer token instead"),
+    user_name: str | None = Query(None, include_in_schema=False),
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await find_cart_owner(token, username or user_name, db)
+
+
+# the same for read-only routes, a cache miss is looked up on the request's read session
+async def get_current_cart_for_read(
+    token: str | None = Depends(optional_oauth2_scheme),
+    username: str | None = Query(None, description="Deprecated, send a bearer token instead"),
+    user_name: str | None = Query(None, include_in_schema=False),
+    db: AsyncSession = Depends(get_read_db),
+):
+    return await find_cart_owner(token, username or user_name, db)
+
+
+async def find_cart_owner(token: str | None, name: str | None, db: AsyncSession):
+    if token:
+        payload = decode_access_token(token)
+        # the cart id was signed into the token at login
+        if AUTH_TRUST_TOKEN_CLAIMS and "user_id" in payload and "cart_id" in payload:
+            auth_stats["token_claims"] += 1
+            return CartOwner(user_id=payload["user_id"], username=payload["sub"], cart_id=payload["cart_id"])
+        name = payload["sub"]
+    # older clients name the user in the query string
+    elif not name:
+        raise credentials_exception()
+
+    owner = await get_cached_cart(name)
+    if owner is not None:
+        return owner
+
+    # oldest cart first, the same cart every endpoint works on
+    result = await db.execute(
+        select(models.User.user_id, models.User.username, func.min(models.Cart.cart_id).label("cart_id"))
+        .outerjoin(models.Cart, models.Cart.user_id == models.User.user_id)
+        .where(models.User.username == name)
+        .group_by(models.User.user_id, models.User.username)
     )
-    db.add(new_item)
-    db.commit()
-    db.refresh(new_item)
-    return new_item
+    row = result.first()
+    if not row:
+        raise not_found_404(details="User does not exist")
+    if row.cart_id is None:
+        raise not_found_404(details="User cart does not exist")
+
+    owner = CartOwner(user_id=row.user_id, username=row.username, cart_id=row.cart_id)
+    await cache_cart(owner)
+    return owner
+
 
+# the cart went away after its id was cached or signed into a token
+async def cart_gone(owner: CartOwner, db: AsyncSession):
+    await db.rollback()
+    await invalidate_cart(owner.username)
+    return not_found_404(details="User cart does not exist")
 
-# use cart id or username to fetch user id OR use authentication
-def view_contents(cart_id: int, db: Session):
-    items = db.query(models.CartItem).filter(models.CartItem.cart_id == cart_id).all()
-    if not items:
+
+# a cart line as fetch_cart_lines returns it, price is the line price
+CartLine = namedtuple("CartLine", ["product_name", "quantity", "price", "total"])
+
+
+# cart lines with their prices and the grand total, in a single query
+async def fetch_cart_lines(cart_id: int, db: AsyncSession):
+    if cart_store.write_behind:
+        return await fetch_held_cart_lines(cart_id, db)
+
+    line_price = models.CartItem.quantity * models.Product.price
+    result = await db.execute(
+        select(
+            models.Product.name.label("product_name"),
+            models.CartItem.quantity,
+            line_price.label("price"),
+            func.sum(line_price).over().label("total"),
+        )
+        .join(models.Product, models.Product.product_id == models.CartItem.product_id)
+        .where(models.CartItem.cart_id == cart_id)
+        .order_by(models.CartItem.cart_item_id)
+    )
+    lines = result.all()
+    if not lines:
         raise not_found_404(details="No item have been added to your cart")
-    return items
+    return lines
 
 
-# remove a product from cart
-def remove_from_cart(prod_id: int, db: Session):
-    item = db.query(models.CartItem).filter(models.CartItem.product_id == prod_id).first()
-    if not item:
-        raise not_found_404(details="Product does not exist in cart")
-    db.delete(item)
-    db.commit()
-    return {"message": "Product deleted successfully"}
+# the same lines from the cart store, prices from one IN query
+async def fetch_held_cart_lines(cart_id: int, db: AsyncSession):
+    held = await cart_store.quantities(cart_id, db)
+    if not held:
+        raise not_found_404(details="No item have been added to your cart")
+    result = await db.execute(
+        select(models.Product.product_id, models.Product.name, models.Product.price)
+        .where(models.Product.product_id.in_(list(held)))
+    )
+    products = {row.product_id: row for row in result.all()}
+    priced = [
+        (products[product_id].name, quantity, quantity * products[product_id].price)
+        for product_id, quantity in held.items() if product_id in products
+    ]
+    total = sum(price for _, _, price in priced)
+    return [CartLine(name, quantity, price, total) for name, quantity, price in priced]
 
 
-def update_prod_quantity():
-    pass
+# the lines as listed to the user, exactly the keys of CartLineRow
+def cart_line_items(lines):
+    return [{"product_name": line.product_name, "quantity": line.quantity, "price": line.price} for line in lines]
 
 
 @router.post("/new-cart", description="Create new empty cart")
-async def create_cart(your_name: str, db: Session = Depends(get_db)):
+async def create_cart(your_name: str, db: AsyncSession = Depends(get_async_db)):
     # check if user exists in db
-    user = db.query(models.User).filter(models.User.username == your_name).first()
+    user = await get_user_by_name(your_name, db)
     if not user:
         raise not_found_404(details="User does not exist")
 
     # create new cart with for user and save to db
     cart = models.Cart(user_id=user.user_id)
     db.add(cart)
-    db.commit()
-    db.refresh(cart)
+    await db.commit()
+    await db.refresh(cart)
+    await invalidate_cart(user.username)
 
     return {"message": "Cart is empty. Add products to your cart"}
 
 
 @router.get("/view-items", description="View all the products in your cart")
-async def view_cart_content(username: str, db: Session = Depends(get_db)):
-    # check if user exists in db
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if not user:
-        raise not_found_404(details="User does not exist")
-
-    # get user cart
-    cart = db.query(models.Cart).filter(models.Cart.user == user).first()
-    if not cart:
-        raise not_found_404(details="User cart does not exist")
+async def view_cart_content(
+    owner: CartOwner = Depends(get_current_cart_for_read), db: AsyncSession = Depends(get_read_db)
+):
+    # cart items with product name and line price, totals computed by postgres
+    lines = await fetch_cart_lines(owner.cart_id, db)
 
-    # get all items in cart
-    cart_items = view_contents(cart_id=cart.cart_id, db=db)
-
-    content = []
-    for item in cart_items:
-        prod = item.product
-        content.append(
-            {
-                "product_name": prod.name,
-                "quantity": item.quantity,
-                "price": item.quantity * prod.price
-            }
-        )
-
-    return content
+    return FastJSONResponse(cart_lines_serializer.dump_json(cart_line_items(lines)))
 
 
 @router.post("/add-item", description="Add a product to your cart")
-async def add_new_product(user_name: str, new_product: Item, db: Session = Depends(get_db)):
-    # check if the user exists
-    user = db.query(models.User).filter(models.User.username == user_name).first()
-    if not user:
-        raise not_found_404(details="User does not exist")
-
-    # get user cart
-    cart = db.query(models.Cart).filter(models.Cart.user == user).first()
-    if not cart:
-        raise not_found_404(details="User cart does not exist")
-
+async def add_new_product(
+    new_product: Item, owner: CartOwner = Depends(get_current_cart), db: AsyncSession = Depends(get_async_db)
+):
     # quantity of new product
     quantity = new_product.quantity
 
-    # check if product exists
-    db_prod = db.query(models.Product).filter(models.Product.name == new_product.product_name).first()
-    if not db_prod:
-        raise not_found_404(details=new_product.product_name)
-
-    # quantity of product in db
-    db_quantity = db_prod.quantity
-
-    # if the quantity requested is more than existing, raise not acceptable error
-    if quantity > db_quantity:
+    # reserve the stock only if enough is available, concurrent buyers cannot oversell
+    try:
+        product_id = await reserve_by_name(owner.cart_id, new_product.product_name, quantity, db)
+    except IntegrityError:
+        raise await cart_gone(owner, db)
+    if product_id is None:
+        await db.rollback()
+        # check if product exists
+        result = await db.execute(
+            select(models.Product.available).where(models.Product.name == new_product.product_name)
+        )
+        db_quantity = result.scalar()
+        if db_quantity is None:
+            raise not_found_404(details=new_product.product_name)
+        # if the quantity requested is more than existing, raise not acceptable error
         raise HTTPException(
             status_code=status.HTTP_406_NOT_ACCEPTABLE,
             detail=f"Not much product at the moment, {db_quantity} left"
         )
 
-    # check if product exist in cart
-    # prod_cart = db.query(models.CartItem).filter(models.CartItem.product == db_prod).first()
-    prod_cart = db.query(models.CartItem).filter(
-        models.CartItem.cart == cart,
-        models.CartItem.product == db_prod
-    ).first()
-
-    # if product exists in the cart, update the quantity
-    if prod_cart:
-        prod_cart.quantity += quantity
-        db_prod.quantity -= quantity
-        # new_quantity = prod_cart.quantity + quantity
-        # new_quantity_db = db_quantity - quantity
-        # setattr(prod_cart, "quantity", new_quantity)
-        # setattr(db_prod, "quantity", new_quantity_db)
-        db.commit()
-        return {"message": "product update successfully"}
-    else:
-        # add new product to cart
-        user_cart = add_to_cart(cart_id=cart.cart_id, product_id=db_prod.product_id, quantity=quantity, db=db)
+    # add the product to the cart in the same transaction as the reservation
+    try:
+        lines = await cart_store.commit(owner.cart_id, {product_id: quantity}, db)
+        line_quantity = lines[product_id]
+    except IntegrityError:
+        raise await cart_gone(owner, db)
 
-        db_prod.quantity -= quantity
-        db.commit()
+    # the line had no quantity before when it holds exactly what was just added
+    if line_quantity == quantity:
         return {"message": "product added successfully"}
+    return {"message": "product update successfully"}
 
-    # return {"message": "could not add product"}
 
+@router.put("/update-item", description="Set the quantity of a product in your cart, 0 removes it")
+async def update_prod_quantity(
+    item: ItemUpdate, owner: CartOwner = Depends(get_current_cart), db: AsyncSession = Depends(get_async_db)
+):
+    operation = CartOperation(op="set", product_name=item.product_name, quantity=item.quantity)
+    try:
+        await apply_cart_operations(owner.cart_id, [operation], db)
+    except IntegrityError:
+        raise await cart_gone(owner, db)
 
-@router.delete("/remove-product", description="remove a product from your cart")
-async def remove_product(username: str, product_name: str, db: Session = Depends(get_db)):
-    # check if user exists
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if not user:
-        raise not_found_404(details="User does not exist")
+    return {"message": "product quantity updated"}
 
-    # check if user has cart
-    cart = db.query(models.Cart).filter(models.Cart.user == user).first()
-    if not cart:
-        raise not_found_404("User cart does not exist")
 
-    # check if product exists
-    db_prod = db.query(models.Product).filter(models.Product.name == product_name).first()
-    if not db_prod:
-        raise not_found_404(details=product_name)
+@router.post("/batch", description="Add, set or remove several products in your cart in one request")
+async def update_cart_batch(
+    batch: CartBatch, owner: CartOwner = Depends(get_current_cart), db: AsyncSession = Depends(get_async_db)
+):
+    # either every operation applies or none does
+    try:
+        changed = await apply_cart_operations(owner.cart_id, batch.operations, db)
+    except IntegrityError:
+        raise await cart_gone(owner, db)
 
-    # check if product exists in cart
-    prod_cart = db.query(models.CartItem).filter(
-        models.CartItem.cart == cart,
-        models.CartItem.product == db_prod
-    ).first()
+    return {
+        "message": f"{len(batch.operations)} operations applied",
+        "items": [{"product_name": name, "quantity": quantity} for name, quantity in changed.items()],
+    }
 
-    # remove the product
-    remova = remove_from_cart(prod_cart.product_id, db)
 
-    if remova:
-        db_prod.quantity += prod_cart.quantity
-    db.commit()
+@router.delete("/remove-product", description="remove a product from your cart")
+async def remove_product(
+    product_name: str, owner: CartOwner = Depends(get_current_cart), db: AsyncSession = Depends(get_async_db)
+):
+    # remove the product and release its reservation, in one transaction; the cart is
+    # locked before its line, as checkout locks them
+    await touch_cart(owner.cart_id, db)
+    removed = await cart_store.take(owner.cart_id, product_name, db)
+    if not removed:
+        raise not_found_404(details="Product does not exist in cart")
+    product_id, quantity = removed
+    try:
+        await reserve(owner.cart_id, {product_id: -quantity}, db)
+        await db.commit()
+    except SQLAlchemyError:
+        await db.rollback()
+        await cart_store.restore(owner.cart_id, product_id, quantity)
+        raise
 
-    return remova
+    return {"message": "Product deleted successfully"}
 
 
 @router.delete("/delete-cart", description="remove a cart associated with a user")
-async def remove_cart(username: str, db: Session = Depends(get_db)):
-    # check if user exists
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if not user:
-        raise not_found_404(details="User does not exist")
-
-    # check if user has cart
-    cart = db.query(models.Cart).filter(models.Cart.user == user).first()
-    if not cart:
-        raise not_found_404("User cart does not exist")
+async def remove_cart(owner: CartOwner = Depends(get_current_cart), db: AsyncSession = Depends(get_async_db)):
+    # a write-behind store writes the cart out first, so every line gives its stock back
+    async with cart_store.checkout(owner.cart_id):
+        # locked, so no line can be added between returning the stock and deleting the cart
+        result = await db.execute(
+            select(models.Cart.cart_id).where(models.Cart.cart_id == owner.cart_id).with_for_update()
+        )
+        if result.scalar() is None:
+            raise await cart_gone(owner, db)
 
-    db.delete(cart)
-    db.commit()
+        await delete_carts(db, [owner.cart_id])
+        await db.commit()
+    await invalidate_cart(owner.username)
 
     return {"message": "User cart deleted"}
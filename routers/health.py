@@ -0,0 +1,33 @@
+import asyncio
+import os
+
+from fastapi import APIRouter, Response, status
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import ping_database
+
+router = APIRouter()
+
+# seconds the readiness probe waits for the database
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "2"))
+
+# set by the lifespan once the engines are up, cleared again when shutting down
+state = {"ready": False}
+
+
+@router.get("/live", description="The process is up and serving requests")
+async def liveness():
+    return {"status": "ok"}
+
+
+@router.get("/ready", description="Startup has finished and the database answers, 503 otherwise")
+async def readiness(response: Response):
+    if not state["ready"]:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "starting"}
+    try:
+        await asyncio.wait_for(ping_database(), READINESS_TIMEOUT)
+    except (asyncio.TimeoutError, SQLAlchemyError, OSError):
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "database unavailable"}
+    return {"status": "ok"}
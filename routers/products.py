@@ -1,34 +1,65 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 from fastapi.encoders import jsonable_encoder
-from sqlalchemy.orm import Session
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import models
-from database import engine
-from routers.users import get_db
-from schemas.product import ProductCreate, ProductInDB, Product
-
-models.Base.metadata.create_all(bind=engine)
+from conditional import (
+    product_etag, page_etag, is_conditional, not_modified, validator_headers, not_modified_response,
+)
+from dependencies import get_async_db, get_read_db
+from pagination import encode_cursor, decode_cursor
+from product_cache import get_cached_product_by_name, peek_cached_product_by_name, invalidate_product, load_product
+from product_export import export_products
+from product_search import PRODUCT_COLUMNS, search_products
+from product_import import stream_lines, ndjson_records, csv_records, import_products
+from schemas.product import ProductCreate, ProductInDB, Product, ProductPage, ImportReport
+from serialization import FastJSONResponse, product_page_serializer
 
 router = APIRouter()
 
 
-def create_product(db: Session, new_product: ProductCreate):
+def name_taken_406(name: str):
+    return HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=f"product name {name} has been taken")
+
+PRODUCT_FIELDS = tuple(column.key for column in PRODUCT_COLUMNS)
+
+# orderings of the product list, ties are broken by product_id
+PRODUCT_ORDERINGS = {
+    "product_id": models.Product.product_id,
+    "price": models.Product.price,
+    "name": models.Product.name,
+}
+
+
+async def create_product(db: AsyncSession, new_product: ProductCreate):
     new = models.Product(
         name=new_product.name,
         description=new_product.description,
         quantity=new_product.quantity,
+        available=new_product.quantity,
         price=new_product.price,
     )
     db.add(new)
-    db.commit()
-    db.refresh(new)
+    # names are unique, a taken one fails the insert
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise name_taken_406(new_product.name)
+    await db.refresh(new)
 
     return new
 
 
 # read by name only [others later]
-def read_product_by_name(prod_name: str, db: Session):
-    product = db.query(models.Product).filter(models.Product.name == prod_name).first()
+async def read_product_by_name(prod_name: str, db: AsyncSession):
+    result = await db.execute(select(models.Product).where(models.Product.name == prod_name))
+    product = result.scalars().first()
     if not product:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Product with name {prod_name} not found.")
     return product
@@ -39,47 +70,185 @@ def update_product():
     pass
 
 
-def remove_product(name: str, db: Session):
-    product = read_product_by_name(prod_name=name, db=db)
-    db.delete(product)
-    db.commit()
+async def remove_product(name: str, db: AsyncSession):
+    product = await read_product_by_name(prod_name=name, db=db)
+    await db.delete(product)
+    await db.commit()
+    await invalidate_product(product.name, product_id=product.product_id)
     return {"message": f"product with name {name} deleted successfully"}
 
 
 @router.post("/create-product", response_model=ProductInDB)
-async def create_new_product(product: ProductCreate, db: Session = Depends(get_db)):
-    new_pro = create_product(db=db, new_product=product)
+async def create_new_product(product: ProductCreate, db: AsyncSession = Depends(get_async_db)):
+    new_pro = await create_product(db=db, new_product=product)
+    await invalidate_product(new_pro.name, product_id=new_pro.product_id)
     return new_pro
 
 
-@router.get("/products/{name}", response_model=Product)
-async def get_product_by_name(name: str, db: Session = Depends(get_db)):
-    prod = read_product_by_name(prod_name=name, db=db)
+@router.get("/products/{name}", response_model=ProductInDB)
+async def get_product_by_name(
+        name: str,
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(get_read_db)
+):
+    prod = await peek_cached_product_by_name(name)
+    if is_conditional(request):
+        # stock moves bump the version without dropping the cached snapshot, so a
+        # revalidation is answered from the row's version, read alone, never the snapshot
+        result = await db.execute(
+            select(models.Product.product_id, models.Product.version, models.Product.updated_at)
+            .where(models.Product.name == name)
+        )
+        current = result.first()
+        if not current:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Product with name {name} not found.")
+        headers = validator_headers(product_etag(current.product_id, current.version), current.updated_at)
+        if not_modified(request, headers["ETag"], current.updated_at):
+            return not_modified_response(headers)
+        if prod is not None and prod.version != current.version:
+            prod = await load_product(db, models.Product.name == name)
+
+    if prod is None:
+        prod = await get_cached_product_by_name(db, name)
+    if not prod:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Product with name {name} not found.")
+
+    # validators of the snapshot being served, so body and ETag always agree
+    headers = validator_headers(product_etag(prod.product_id, prod.version), prod.updated_at)
+    if not_modified(request, headers["ETag"], prod.updated_at):
+        return not_modified_response(headers)
+    response.headers.update(headers)
     return prod
 
 
-@router.get("/product_list", response_model=list[Product])
-async def product_list(skip: int = 0, limit: int = 50, db: Session = Depends(get_db)):
-    items = db.query(models.Product).offset(skip).limit(limit).all()
+@router.get("/search", response_model=ProductPage, description="Ranked search over product name and description")
+async def search_product_catalog(
+        q: str = Query(min_length=1, max_length=200),
+        limit: int = Query(20, ge=1, le=100),
+        cursor: str | None = None,
+        db: AsyncSession = Depends(get_read_db)
+):
+    return await search_products(db, q, limit=limit, cursor=cursor)
+
+
+def product_page_query(columns, skip: int, limit: int, cursor: str | None, order_by: str):
+    order_column = PRODUCT_ORDERINGS[order_by]
+    query = select(*columns)
+
+    # keyset pagination: continue after the last row of the previous page, any page costs the same
+    if cursor:
+        if order_by == "product_id":
+            last_id, = decode_cursor(cursor, order_by, 1)
+            query = query.where(models.Product.product_id > last_id)
+        else:
+            values = decode_cursor(cursor, order_by, 2)
+            query = query.where(tuple_(order_column, models.Product.product_id) > tuple_(*values))
+    # offset is kept as a fallback, deep pages scan and discard every skipped row
+    elif skip:
+        query = query.offset(skip)
+
+    if order_by == "product_id":
+        query = query.order_by(models.Product.product_id)
+    else:
+        query = query.order_by(order_column, models.Product.product_id)
+    return query.limit(limit)
+
+
+@router.get("/product_list", response_model=ProductPage)
+async def product_list(
+        request: Request,
+        skip: int = 0,
+        limit: int = 50,
+        cursor: str | None = None,
+        order_by: Literal["product_id", "price", "name"] = "product_id",
+        db: AsyncSession = Depends(get_read_db)
+):
+    # a page is identified by the ids and versions on it; a revalidation reads only those.
+    # If-Modified-Since is not answered here, a deleted row does not move the newest timestamp
+    if "if-none-match" in request.headers:
+        result = await db.execute(
+            product_page_query((models.Product.product_id, models.Product.version), skip, limit, cursor, order_by)
+        )
+        etag = page_etag(result.all())
+        if not_modified(request, etag):
+            return not_modified_response(validator_headers(etag))
+
+    # plain rows, the page is written to JSON without building Product instances
+    columns = PRODUCT_COLUMNS + (models.Product.version, models.Product.updated_at)
+    result = await db.execute(product_page_query(columns, skip, limit, cursor, order_by))
+    rows = result.all()
 #     there could be no product. rare.
-    return items
+
+    next_cursor = None
+    if rows and len(rows) == limit:
+        last = rows[-1]
+        if order_by == "product_id":
+            next_cursor = encode_cursor(order_by, last.product_id)
+        else:
+            next_cursor = encode_cursor(order_by, getattr(last, order_by), last.product_id)
+
+    modified = [row.updated_at for row in rows if row.updated_at is not None]
+    headers = validator_headers(
+        page_etag((row.product_id, row.version) for row in rows), max(modified) if modified else None
+    )
+    page = {"items": [dict(zip(PRODUCT_FIELDS, row)) for row in rows], "next_cursor": next_cursor}
+    return FastJSONResponse(product_page_serializer.dump_json(page), headers=headers)
+
+
+@router.post(
+    "/bulk-import",
+    response_model=ImportReport,
+    description="Create or update products from a streamed NDJSON or CSV body, matched on name"
+)
+async def bulk_import_products(
+        request: Request,
+        format: Literal["ndjson", "csv"] = "ndjson",
+        batch_size: int = Query(1000, ge=1, le=5000),
+        db: AsyncSession = Depends(get_async_db)
+):
+    # the body is parsed as it arrives, each batch is validated and upserted in its own transaction
+    lines = stream_lines(request.stream())
+    records = csv_records(lines) if format == "csv" else ndjson_records(lines)
+    return await import_products(db, records, batch_size=batch_size)
+
+
+@router.get("/export", description="Stream the whole catalog as NDJSON or CSV")
+async def export_product_catalog(format: Literal["ndjson", "csv"] = "ndjson"):
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_products(format),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=products.{format}"},
+    )
 
 
 @router.delete("/delete/{name}")
-async def remove_product_name(name: str, db: Session = Depends(get_db)):
-    prod = remove_product(name=name, db=db)
+async def remove_product_name(name: str, db: AsyncSession = Depends(get_async_db)):
+    prod = await remove_product(name=name, db=db)
     return prod
 
 
 @router.put("/update/{name}", response_model=Product)
-async def update_product(name: str, product: Product, db: Session = Depends(get_db)):
-    prod = read_product_by_name(prod_name=name, db=db)
+async def update_product(name: str, product: Product, db: AsyncSession = Depends(get_async_db)):
+    prod = await read_product_by_name(prod_name=name, db=db)
 
     update_prod = jsonable_encoder(product)
+    # reservations stay, the change of stock on hand moves what is available by as much
+    prod.available = models.Product.available + (update_prod["quantity"] - (prod.quantity or 0))
     for field in update_prod:
         setattr(prod, field, update_prod[field])
-
-    # Commit the changes to the database
-    db.commit()
+    # new ETag and Last-Modified for the detail and list responses
+    for field, value in models.product_version_bump().items():
+        setattr(prod, field, value)
+
+    # Commit the changes to the database, renaming to a taken name fails
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise name_taken_406(product.name)
+    # the name may have changed, drop both
+    await invalidate_product(name, prod.name, product_id=prod.product_id)
 
     return prod
@@ -1,43 +1,120 @@
 from fastapi import APIRouter, HTTPException, status, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, delete, func, literal
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
 import models
-from routers.carts import not_found_404
-from routers.users import get_db
+from cart_store import cart_store
+from dependencies import get_async_db
+from reservations import settle, sell
+from routers.carts import fetch_cart_lines, cart_line_items, get_current_cart, cart_gone, not_found_404
+from schemas.cart import CartOwner
+from serialization import FastJSONResponse
+from schemas.transaction import Transaction, TransactionCreated
+from workers.orders import order_worker
 
 router = APIRouter()
 
 
 @router.get("/checkout", description="Checkout the total price of your products")
-async def checkout_product(username: str, db: Session = Depends(get_db)):
-    # check if the user exists
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if not user:
-        raise not_found_404(details="User does not exist")
-
-    # get user cart
-    cart = db.query(models.Cart).filter(models.Cart.user == user).first()
-    if not cart:
-        raise not_found_404(details="User cart does not exist")
-
-    # get products from user cart
-    prod_cart = db.query(models.CartItem).filter(models.CartItem.cart == cart,).all()
-    if not prod_cart:
-        raise not_found_404(details="No product has been added to cart")
+async def checkout_product(owner: CartOwner = Depends(get_current_cart), db: AsyncSession = Depends(get_async_db)):
+    # products in the user cart with line prices and the total, one query
+    lines = await fetch_cart_lines(owner.cart_id, db)
 
     # return the total price of the products
-    content = []
-    total_price = 0
-    for item in prod_cart:
-        prod = item.product
-        total_price += item.quantity * prod.price
-        content.append(
-            {
-                "product_name": prod.name,
-                "quantity": item.quantity,
-                "price": item.quantity * prod.price
-            }
+    content = cart_line_items(lines)
+    content.append({"total amount": lines[0].total})
+    return FastJSONResponse(content)
+
+
+@router.post(
+    "/checkout",
+    response_model=TransactionCreated,
+    status_code=status.HTTP_202_ACCEPTED,
+    description="Place an order for the products in your cart, fulfilment happens in the background"
+)
+async def place_order(owner: CartOwner = Depends(get_current_cart), db: AsyncSession = Depends(get_async_db)):
+    # a write-behind cart store writes the cart out first and holds it until the order is in
+    async with cart_store.checkout(owner.cart_id):
+        order = await create_order(owner, db)
+
+    order_worker.notify()
+    return {"transaction_id": order.transaction_id, "status": "pending", "total_amount": order.total_amount}
+
+
+# the order and its lines from the cart in the database, and the emptied cart, in one transaction
+async def create_order(owner: CartOwner, db: AsyncSession):
+    # the cart row stays locked so a double submit cannot order twice
+    result = await db.execute(
+        select(models.Cart.cart_id).where(models.Cart.cart_id == owner.cart_id).with_for_update()
+    )
+    if result.scalar() is None:
+        raise await cart_gone(owner, db)
+
+    # lines whose hold expired reserve their stock again, or the order is refused
+    short_ids = await settle(owner.cart_id, db)
+    if short_ids:
+        await db.rollback()
+        result = await db.execute(select(models.Product.name).where(models.Product.product_id.in_(short_ids)))
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail=f"No longer available: {', '.join(result.scalars().all())}"
         )
 
-    content.append({"total amount": total_price})
-    return content
+    total = (
+        select(func.sum(models.CartItem.quantity * models.Product.price))
+        .join(models.Product, models.Product.product_id == models.CartItem.product_id)
+        .where(models.CartItem.cart_id == owner.cart_id)
+        .scalar_subquery()
+    )
+
+    # the order with its total, taken straight from the cart
+    result = await db.execute(
+        insert(models.Transaction)
+        .values(user_id=owner.user_id, status="pending", total_amount=total)
+        .returning(models.Transaction.transaction_id, models.Transaction.total_amount)
+    )
+    order = result.first()
+    if order.total_amount is None:
+        await db.rollback()
+        raise not_found_404(details="No product has been added to cart")
+
+    # snapshot the cart lines into the order, sell what the cart held, then empty the cart
+    await db.execute(
+        insert(models.TransactionLine).from_select(
+            ["transaction_id", "product_id", "product_name", "quantity", "unit_price"],
+            select(
+                literal(order.transaction_id),
+                models.CartItem.product_id,
+                models.Product.name,
+                models.CartItem.quantity,
+                models.Product.price,
+            )
+            .join(models.Product, models.Product.product_id == models.CartItem.product_id)
+            .where(models.CartItem.cart_id == owner.cart_id),
+        )
+    )
+    await sell(owner.cart_id, db)
+    await db.execute(
+        delete(models.CartItem)
+        .where(models.CartItem.cart_id == owner.cart_id)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return order
+
+
+@router.get("/orders/{transaction_id}", response_model=Transaction, description="Status and lines of an order")
+async def get_order(
+    transaction_id: int, owner: CartOwner = Depends(get_current_cart), db: AsyncSession = Depends(get_async_db)
+):
+    # someone else's order reads as missing, so order ids cannot be probed
+    result = await db.execute(
+        select(models.Transaction)
+        .options(selectinload(models.Transaction.lines))
+        .where(models.Transaction.transaction_id == transaction_id, models.Transaction.user_id == owner.user_id)
+    )
+    order = result.scalars().first()
+    if not order:
+        raise not_found_404(details="Order does not exist")
+    return order
@@ -1,18 +1,22 @@
+import os
 from datetime import timedelta, datetime
 from typing import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from passlib.context import CryptContext
 from jose import jwt, JWTError
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import models
-from database import SessionLocal, engine
+from cache import TTLCache
+from cart_cache import invalidate_cart
+from database import env_flag
+from dependencies import get_async_db
 from schemas.user import User, UserInDB, UserUpdate
-
-models.Base.metadata.create_all(bind=engine)
+from security import password_hasher
 
 router = APIRouter()
 
@@ -21,8 +25,19 @@ SECRET_KEY = "016a5ba1b6ead05abc518c5676421b3ab3346e09191385bd41284bc1366369a9"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# resolved users by token subject, saves a database round trip per authenticated request
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+# build the user from the token claims alone, no lookup at all
+AUTH_TRUST_TOKEN_CLAIMS = env_flag("AUTH_TRUST_TOKEN_CLAIMS")
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# for endpoints that still accept a username in the query string when no token is sent
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
+
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# users resolved from token claims, next to the cache hits and misses
+auth_stats = {"token_claims": 0}
 
 
 class Token(BaseModel):
@@ -32,39 +47,37 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: str | None = None
-    
 
-# Database dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
 
+# bcrypt runs on the hashing thread pool, never on the event loop
+async def verify_password(plain_password, hashed_password):
+    return await password_hasher.verify(plain_password, hashed_password)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
 
+async def get_password_hash(password):
+    return await password_hasher.hash(password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
 
-
-def get_user(db: Session, username: str):
-    user = db.query(models.User).filter(models.User.username == username).first()
+async def get_user(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    user = result.scalars().first()
     # if user is None:
     #     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Incorrectt credential")
     #
     return user
 
 
-def authenticate_user(username: str, password: str, db: Session):
-    user = get_user(db, username)
+async def authenticate_user(username: str, password: str, db: AsyncSession):
+    user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.password_hash):
+    valid, new_hash = await password_hasher.verify_and_update(password, user.password_hash)
+    if not valid:
         return False
+    # the hash was made with a different bcrypt cost, store it again with the current one
+    if new_hash:
+        user.password_hash = new_hash
+        await db.commit()
     return user
 
 
@@ -80,24 +93,25 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
 
 @router.post("/register", response_model=User)
-async def register_user(user: UserInDB, db: Session = Depends(get_db)):
+async def register_user(user: UserInDB, db: AsyncSession = Depends(get_async_db)):
     # check if username has been taken
-    user_get = db.query(models.User).filter(
-        models.User.username == user.username or models.User.email == user.email
-    ).first()
+    result = await db.execute(select(models.User).where(
+        or_(models.User.username == user.username, models.User.email == user.email)
+    ))
+    user_get = result.scalars().first()
     if user_get is not None:
         raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail="username or email has been taken")
 
     # save user details to database
     new_user = models.User(
         username=user.username,
-        password_hash=get_password_hash(user.password),  # hash the password
+        password_hash=await get_password_hash(user.password),  # hash the password
         email=user.email,
         full_name=user.full_name,
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user
 
 
@@ -116,23 +130,47 @@ async def register_user(user: UserInDB, db: Session = Depends(get_db)):
 #     return {"access_token": encoded_jwt, "token_type": "bearer"}
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+def credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+# claims of a valid token, the username is in "sub"
+def decode_access_token(token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=ALGORITHM)
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
     except JWTError:
-        raise credentials_exception
-    user = get_user(db, username=token_data.username)
+        raise credentials_exception()
+    if payload.get("sub") is None:
+        raise credentials_exception()
+    return payload
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    payload = decode_access_token(token)
+    username: str = payload["sub"]
+    token_data = TokenData(username=username)
+
+    # claims are signed by us, but only reflect the user as it was at login
+    if AUTH_TRUST_TOKEN_CLAIMS and "user_id" in payload:
+        auth_stats["token_claims"] += 1
+        return User(
+            user_id=payload["user_id"],
+            username=username,
+            email=payload.get("email", ""),
+            full_name=payload.get("full_name", ""),
+        )
+
+    user = user_cache.get(token_data.username)
     if user is None:
-        raise credentials_exception
+        db_user = await get_user(db, username=token_data.username)
+        if db_user is None:
+            raise credentials_exception()
+        user = User.model_validate(db_user)
+        user_cache.set(token_data.username, user)
     return user
 
 
@@ -145,19 +183,24 @@ async def get_current_active_user(
 @router.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = authenticate_user(db=db, username=form_data.username, password=form_data.password)
+    user = await authenticate_user(db=db, username=form_data.username, password=form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    claims = {"sub": user.username, "user_id": user.user_id, "email": user.email, "full_name": user.full_name}
+    if AUTH_TRUST_TOKEN_CLAIMS:
+        # cart endpoints then work on this cart without looking the user up
+        result = await db.execute(select(func.min(models.Cart.cart_id)).where(models.Cart.user_id == user.user_id))
+        cart_id = result.scalar()
+        if cart_id is not None:
+            claims["cart_id"] = cart_id
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
+    access_token = create_access_token(data=claims, expires_delta=access_token_expires)
     return {"access_token": access_token, "token_type": "bearer"}
 
 
@@ -171,16 +214,26 @@ async def get_user_profile(current_user: Annotated[User, Depends(get_current_act
 async def update_user_profile(
         updated_user: UserUpdate,
         current_user: Annotated[User, Depends(get_current_active_user)],
-        db=Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ):
-    user = db.query(models.User).filter(models.User.username == current_user).first()
+    user = await db.get(models.User, current_user.user_id)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
     for key, value in updated_user.model_dump().items():
         setattr(user, key, value)
 
-    db.commit()
-    db.refresh(user)
+    # usernames and emails are unique
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail="username or email has been taken")
+    await db.refresh(user)
+
+    # the cached copy is stale now, under the old and a possibly new username
+    user_cache.delete(current_user.username)
+    user_cache.delete(user.username)
+    await invalidate_cart(current_user.username, user.username)
 
     return user
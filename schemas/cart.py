@@ -1,6 +1,8 @@
 from datetime import datetime
+from typing import Literal
 
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+from typing_extensions import TypedDict
 
 
 class CartBase(BaseModel):
@@ -16,6 +18,13 @@ class CreateCart(CartBase):
     model_config = ConfigDict(from_attributes=True)
 
 
+# the user and cart a request works on, resolved once per request
+class CartOwner(BaseModel):
+    user_id: int
+    username: str
+    cart_id: int
+
+
 # cart item models
 class ItemBase(BaseModel):
     cart_id: int
@@ -30,5 +39,35 @@ class ItemAdd(ItemBase):
 
 
 class Item(BaseModel):
+    product_name: str
+    quantity: int = Field(gt=0)
+
+
+class ItemUpdate(BaseModel):
+    product_name: str
+    # 0 removes the product from the cart
+    quantity: int = Field(ge=0)
+
+
+# batch of cart changes, applied in order in one transaction
+class CartOperation(BaseModel):
+    op: Literal["add", "set", "remove"]
+    product_name: str
+    quantity: int = Field(0, ge=0)
+
+    @model_validator(mode="after")
+    def check_quantity(self):
+        if self.op == "add" and self.quantity == 0:
+            raise ValueError("add needs a quantity above 0")
+        return self
+
+
+class CartBatch(BaseModel):
+    operations: list[CartOperation] = Field(min_length=1, max_length=500)
+
+
+# a cart line as listed to the user, serialized straight from the fetched row
+class CartLineRow(TypedDict):
     product_name: str
     quantity: int
+    price: float
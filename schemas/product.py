@@ -1,4 +1,7 @@
+from datetime import datetime
+
 from pydantic import BaseModel, ConfigDict
+from typing_extensions import TypedDict
 
 
 class ProductBase(BaseModel):
@@ -10,6 +13,14 @@ class ProductBase(BaseModel):
 
 class ProductInDB(ProductBase):
     product_id: int
+    # stock on hand that no cart holds
+    available: int | None = None
+
+
+# cached snapshot, with the validators the detail endpoint answers conditional requests from
+class CachedProduct(ProductInDB):
+    version: int
+    updated_at: datetime | None = None
 
 
 class ProductCreate(ProductBase):
@@ -20,5 +31,45 @@ class Product(ProductBase):
     pass
 
 
+class ProductPage(BaseModel):
+    items: list[ProductInDB]
+    # pass back as cursor to get the next page, null on the last page
+    next_cursor: str | None = None
+
+
+# product rows as fetched, serialized without building models first
+class ProductRow(TypedDict):
+    product_id: int
+    name: str
+    description: str
+    price: float
+    quantity: int
+    available: int | None
+
+
+class ProductPageRows(TypedDict):
+    items: list[ProductRow]
+    next_cursor: str | None
+
+
+# bulk import report
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+
+class ImportBatch(BaseModel):
+    batch: int
+    first_line: int
+    last_line: int
+    imported: int
+    failed: int
+    # capped per batch, failed has the full count
+    errors: list[ImportRowError]
 
 
+class ImportReport(BaseModel):
+    rows: int
+    imported: int
+    failed: int
+    batches: list[ImportBatch]
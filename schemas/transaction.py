@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from pydantic import BaseModel, ConfigDict
+
+
+class TransactionLine(BaseModel):
+    product_id: int | None
+    product_name: str
+    quantity: int
+    unit_price: float
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class TransactionBase(BaseModel):
+    transaction_id: int
+    # pending, processing, completed or failed
+    status: str
+    total_amount: float
+
+
+class TransactionCreated(TransactionBase):
+    pass
+
+
+class Transaction(TransactionBase):
+    created_at: datetime | None
+    updated_at: datetime | None
+    failure_reason: str | None
+    lines: list[TransactionLine]
+
+    model_config = ConfigDict(from_attributes=True)
@@ -0,0 +1,35 @@
+# Fast path for large JSON responses.
+#
+# Handlers return FastJSONResponse with rows already turned into JSON bytes, which skips
+# FastAPI's response_model validation and jsonable_encoder. The TypeAdapters are built once
+# at import and write plain dicts from the fetched rows, no models are created per row.
+from fastapi.responses import Response
+from pydantic import TypeAdapter
+from pydantic_core import to_json
+
+from schemas.cart import CartLineRow
+from schemas.product import ProductPageRows
+
+try:
+    import orjson
+except ImportError:  # optional, pydantic's own encoder is the fallback
+    orjson = None
+
+product_page_serializer = TypeAdapter(ProductPageRows)
+cart_lines_serializer = TypeAdapter(list[CartLineRow])
+
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content)
+    return to_json(content)
+
+
+# JSON response for content that is already bytes, or plain dicts and lists
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content):
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
@@ -0,0 +1,80 @@
+import os
+import tempfile
+
+# settings are read when the app modules are imported, so they are set first
+DATABASE_PATH = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DATABASE_PATH}"
+os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{DATABASE_PATH}"
+os.environ["ORDER_WORKER_ENABLED"] = "false"
+os.environ["CART_SWEEPER_ENABLED"] = "false"
+os.environ["RESERVATION_EXPIRY_ENABLED"] = "false"
+os.environ["BCRYPT_ROUNDS"] = "4"
+os.environ["ADMIN_TOKEN"] = "test-admin-token"
+
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+
+import database
+import models
+from main import app
+
+
+@pytest.fixture(scope="session")
+def client():
+    models.Base.metadata.create_all(bind=database.init_sync_engine())
+    with TestClient(app) as client:
+        yield client
+
+
+# runs a coroutine function on the app's event loop, where its engine and pool live
+@pytest.fixture
+def run(client):
+    def call(function, *args):
+        return client.portal.call(function, *args)
+    return call
+
+
+@pytest.fixture
+def make_product(client):
+    def create(quantity: int = 10, price: float = 2.0):
+        name = f"product-{uuid.uuid4().hex[:12]}"
+        client.post("/products/create-product", json={
+            "name": name, "description": "test", "price": price, "quantity": quantity,
+        }).raise_for_status()
+        return name
+    return create
+
+
+# a new user with a cart holding product name -> quantity, returns the username
+@pytest.fixture
+def make_cart(client):
+    def create(lines: dict[str, int] | None = None):
+        username = f"user-{uuid.uuid4().hex[:12]}"
+        client.post("/users/register", json={
+            "username": username, "email": f"{username}@example.com", "full_name": username, "password": "secret",
+        }).raise_for_status()
+        client.post("/carts/new-cart", params={"your_name": username}).raise_for_status()
+        if lines:
+            client.post("/carts/batch", params={"username": username}, json={
+                "operations": [{"op": "add", "product_name": name, "quantity": q} for name, q in lines.items()],
+            }).raise_for_status()
+        return username
+    return create
+
+
+# products.quantity and products.available as stored, bypassing the product cache
+@pytest.fixture
+def stock(run):
+    async def read(name: str):
+        async with database.AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(models.Product.quantity, models.Product.available).where(models.Product.name == name)
+            )
+            return tuple(result.one())
+
+    def call(name: str):
+        return run(read, name)
+    return call
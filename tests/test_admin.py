@@ -0,0 +1,10 @@
+import pytest
+
+ADMIN_PATHS = ["/admin/pool", "/admin/admission", "/admin/cache", "/admin/workers"]
+
+
+@pytest.mark.parametrize("path", ADMIN_PATHS)
+def test_admin_endpoints_need_the_token(client, path):
+    assert client.get(path).status_code == 403
+    assert client.get(path, headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get(path, headers={"X-Admin-Token": "test-admin-token"}).status_code == 200
@@ -0,0 +1,23 @@
+from cart_cache import invalidate_cart
+from dependencies import get_async_db
+from main import app
+
+
+async def no_primary_session():
+    raise AssertionError("the request used a primary session")
+    yield
+
+
+def test_view_items_looks_up_the_cart_on_the_read_session(client, run, make_product, make_cart):
+    product = make_product()
+    username = make_cart({product: 2})
+    # a cache miss, so the owner is looked up in the database
+    run(invalidate_cart, username)
+
+    app.dependency_overrides[get_async_db] = no_primary_session
+    try:
+        response = client.get("/carts/view-items", params={"username": username})
+    finally:
+        app.dependency_overrides.pop(get_async_db)
+    response.raise_for_status()
+    assert response.json() == [{"product_name": product, "quantity": 2, "price": 4.0}]
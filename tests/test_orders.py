@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+import models
+from database import AsyncSessionLocal
+from workers.orders import OrderWorker, ORDER_LEASE_SECONDS
+
+
+async def claim(worker: OrderWorker):
+    async with AsyncSessionLocal() as db:
+        return await worker.claim_orders(db)
+
+
+async def finish(worker: OrderWorker, payments: dict[int, bool]):
+    async with AsyncSessionLocal() as db:
+        return await worker.finish_orders(db, payments)
+
+
+# as if the worker holding the order stopped renewing it a lease ago
+async def expire_lease(order_id: int):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(models.Transaction)
+            .where(models.Transaction.transaction_id == order_id)
+            .values(updated_at=datetime.utcnow() - timedelta(seconds=ORDER_LEASE_SECONDS + 60))
+        )
+        await db.commit()
+
+
+def place_order(client, username: str):
+    response = client.post("/transactions/checkout", params={"username": username})
+    response.raise_for_status()
+    return response.json()["transaction_id"]
+
+
+def order_status(client, username: str, order_id: int):
+    response = client.get(f"/transactions/orders/{order_id}", params={"username": username})
+    response.raise_for_status()
+    return response.json()["status"]
+
+
+def test_claimed_order_is_not_claimed_again_within_its_lease(client, run, make_product, make_cart):
+    product = make_product(quantity=10)
+    username = make_cart({product: 2})
+    order_id = place_order(client, username)
+
+    assert order_id in run(claim, OrderWorker(batch_size=1000))
+    assert order_id not in run(claim, OrderWorker(batch_size=1000))
+    assert order_status(client, username, order_id) == "processing"
+
+
+def test_reclaimed_order_is_finished_and_restocked_once(client, run, make_product, make_cart, stock):
+    product = make_product(quantity=10)
+    username = make_cart({product: 3})
+    order_id = place_order(client, username)
+    assert stock(product) == (7, 7)
+
+    first, second = OrderWorker(batch_size=1000), OrderWorker(batch_size=1000)
+    assert order_id in run(claim, first)
+    run(expire_lease, order_id)
+    assert order_id in run(claim, second)
+
+    # the first worker declines after all, the second finishes later and changes nothing
+    assert run(finish, first, {order_id: False}) == ([], [order_id])
+    assert run(finish, second, {order_id: False}) == ([], [])
+    assert run(finish, second, {order_id: True}) == ([], [])
+
+    assert order_status(client, username, order_id) == "failed"
+    assert stock(product) == (10, 10)
+
+
+def test_someone_elses_order_is_not_found(client, make_product, make_cart):
+    product = make_product()
+    order_id = place_order(client, make_cart({product: 1}))
+    response = client.get(f"/transactions/orders/{order_id}", params={"username": make_cart()})
+    assert response.status_code == 404
@@ -0,0 +1,37 @@
+import base64
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from pagination import encode_cursor, decode_cursor
+
+
+def raw_cursor(*items):
+    return base64.urlsafe_b64encode(json.dumps(list(items)).encode()).decode().rstrip("=")
+
+
+def test_round_trip():
+    assert decode_cursor(encode_cursor("price", 9.5, 12), "price", 2) == [9.5, 12]
+    assert decode_cursor(encode_cursor("product_id", 7), "product_id", 1) == [7]
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    raw_cursor("product_id"),
+    raw_cursor("product_id", 1, 2),
+    raw_cursor("product_id", [1]),
+    raw_cursor("product_id", {"a": 1}),
+    raw_cursor("product_id", None),
+    raw_cursor("product_id", True),
+])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor, "product_id", 1)
+    assert error.value.status_code == 400
+
+
+def test_product_list_rejects_bad_cursors(client):
+    for cursor in (encode_cursor("price", 1.0, 1), raw_cursor("name", [1, 2], 3)):
+        response = client.get("/products/product_list", params={"order_by": "name", "cursor": cursor})
+        assert response.status_code == 400
@@ -0,0 +1,68 @@
+import json
+import uuid
+
+
+def ndjson(products):
+    return "\n".join(json.dumps(product) for product in products).encode()
+
+
+def product(client, name):
+    response = client.get(f"/products/products/{name}")
+    response.raise_for_status()
+    return response.json()
+
+
+def test_import_writes_several_rows_per_statement(client):
+    prefix = uuid.uuid4().hex[:8]
+    rows = [
+        {"name": f"{prefix}-{i}", "description": f"imported {i}", "price": 1.5 + i, "quantity": 10 * i}
+        for i in range(1, 6)
+    ]
+
+    response = client.post("/products/bulk-import", params={"batch_size": 100}, content=ndjson(rows))
+    response.raise_for_status()
+    report = response.json()
+    assert report["rows"] == 5
+    assert report["imported"] == 5
+    assert report["failed"] == 0
+    assert len(report["batches"]) == 1
+
+    for row in rows:
+        created = product(client, row["name"])
+        assert created["quantity"] == row["quantity"]
+        assert created["available"] == row["quantity"]
+
+
+def test_import_updates_existing_rows(client):
+    prefix = uuid.uuid4().hex[:8]
+    rows = [
+        {"name": f"{prefix}-{i}", "description": "first", "price": 2.0, "quantity": 5}
+        for i in range(3)
+    ]
+    client.post("/products/bulk-import", content=ndjson(rows)).raise_for_status()
+
+    rows = [{**row, "description": "second", "quantity": 8} for row in rows]
+    response = client.post("/products/bulk-import", content=ndjson(rows))
+    response.raise_for_status()
+    assert response.json()["imported"] == 3
+
+    for row in rows:
+        updated = product(client, row["name"])
+        assert updated["description"] == "second"
+        assert updated["quantity"] == 8
+        assert updated["available"] == 8
+
+
+def test_line_that_is_not_utf8_fails_alone(client):
+    prefix = uuid.uuid4().hex[:8]
+    good = ndjson([{"name": f"{prefix}-{i}", "description": "ok", "price": 1.0, "quantity": 1} for i in range(2)])
+    first, second = good.split(b"\n")
+    body = b"\n".join([first, b'{"name": "\xff\xfe"}', second])
+
+    response = client.post("/products/bulk-import", content=body)
+    response.raise_for_status()
+    report = response.json()
+    assert report["rows"] == 3
+    assert report["imported"] == 2
+    assert report["failed"] == 1
+    assert report["batches"][0]["errors"] == [{"line": 2, "error": "invalid utf-8"}]
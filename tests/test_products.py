@@ -0,0 +1,45 @@
+import uuid
+
+
+def new_product(client, name: str, quantity: int = 5):
+    return client.post("/products/create-product", json={
+        "name": name, "description": "test", "price": 3.0, "quantity": quantity,
+    })
+
+
+def test_create_product_with_a_taken_name(client):
+    name = f"{uuid.uuid4().hex[:8]}-taken"
+    new_product(client, name).raise_for_status()
+
+    response = new_product(client, name)
+    assert response.status_code == 406
+    # the session was rolled back, the next write still works
+    new_product(client, f"{name}-other").raise_for_status()
+
+
+def test_rename_product_to_a_taken_name(client):
+    prefix = uuid.uuid4().hex[:8]
+    new_product(client, f"{prefix}-a").raise_for_status()
+    new_product(client, f"{prefix}-b").raise_for_status()
+
+    response = client.put(f"/products/update/{prefix}-b", json={
+        "name": f"{prefix}-a", "description": "renamed", "price": 3.0, "quantity": 5,
+    })
+    assert response.status_code == 406
+    assert client.get(f"/products/products/{prefix}-b").json()["description"] == "test"
+
+
+def test_revalidation_sees_stock_moved_by_carts(client, make_product, make_cart):
+    name = make_product(quantity=10)
+    first = client.get(f"/products/products/{name}")
+    first.raise_for_status()
+    etag = first.headers["ETag"]
+    assert client.get(f"/products/products/{name}", headers={"If-None-Match": etag}).status_code == 304
+
+    # reserving stock bumps the version, the cached snapshot is not dropped
+    make_cart({name: 4})
+
+    response = client.get(f"/products/products/{name}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["available"] == 6
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, func
+
+import models
+from database import AsyncSessionLocal
+from workers.reservations import ReservationExpirer
+
+
+def product_id_of(name: str):
+    return select(models.Product.product_id).where(models.Product.name == name).scalar_subquery()
+
+
+# units held for a product across every cart
+async def reserved(name: str):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(func.coalesce(func.sum(models.StockReservation.quantity), 0))
+            .where(models.StockReservation.product_id == product_id_of(name))
+        )
+        return result.scalar()
+
+
+# as if the holds on a product were made a TTL ago
+async def expire_holds(name: str):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(models.StockReservation)
+            .where(models.StockReservation.product_id == product_id_of(name))
+            .values(expires_at=datetime.utcnow() - timedelta(seconds=1))
+        )
+        await db.commit()
+
+
+async def expire_batch():
+    return await ReservationExpirer(batch_size=1000).expire_batch()
+
+
+def add_item(client, username: str, name: str, quantity: int):
+    return client.post("/carts/add-item", params={"username": username},
+                       json={"product_name": name, "quantity": quantity})
+
+
+def test_adding_reserves_and_refuses_what_is_not_available(client, run, make_product, make_cart, stock):
+    name = make_product(quantity=5)
+    first, second = make_cart(), make_cart()
+
+    add_item(client, first, name, 3).raise_for_status()
+    assert stock(name) == (5, 2)
+    assert run(reserved, name) == 3
+
+    assert add_item(client, second, name, 3).status_code == 406
+    assert stock(name) == (5, 2)
+    assert run(reserved, name) == 3
+
+
+def test_a_short_product_fails_the_whole_batch(client, run, make_product, make_cart, stock):
+    plenty, scarce = make_product(quantity=10), make_product(quantity=1)
+    username = make_cart()
+
+    response = client.post("/carts/batch", params={"username": username}, json={"operations": [
+        {"op": "add", "product_name": plenty, "quantity": 2},
+        {"op": "add", "product_name": scarce, "quantity": 2},
+    ]})
+    assert response.status_code == 406
+    assert stock(plenty) == (10, 10)
+    assert stock(scarce) == (1, 1)
+    assert run(reserved, plenty) == 0
+
+
+def test_lowering_and_removing_lines_release_their_stock(client, run, make_product, make_cart, stock):
+    name = make_product(quantity=10)
+    username = make_cart({name: 6})
+    assert stock(name) == (10, 4)
+
+    client.put("/carts/update-item", params={"username": username},
+               json={"product_name": name, "quantity": 2}).raise_for_status()
+    assert stock(name) == (10, 8)
+    assert run(reserved, name) == 2
+
+    client.delete("/carts/remove-product", params={"username": username, "product_name": name}).raise_for_status()
+    assert stock(name) == (10, 10)
+    assert run(reserved, name) == 0
+
+
+def test_deleting_a_cart_releases_its_stock(client, run, make_product, make_cart, stock):
+    name = make_product(quantity=10)
+    username = make_cart({name: 7})
+
+    client.delete("/carts/delete-cart", params={"username": username}).raise_for_status()
+    assert stock(name) == (10, 10)
+    assert run(reserved, name) == 0
+
+
+def test_expired_holds_return_their_stock_and_the_lines_stay(client, run, make_product, make_cart, stock):
+    name = make_product(quantity=10)
+    username = make_cart({name: 4})
+
+    run(expire_holds, name)
+    assert run(expire_batch) >= 1
+    assert stock(name) == (10, 10)
+    assert run(reserved, name) == 0
+
+    lines = client.get("/carts/view-items", params={"username": username}).json()
+    assert [(line["product_name"], line["quantity"]) for line in lines] == [(name, 4)]
+
+    # checkout reserves the stock again while it is there, then sells it
+    client.post("/transactions/checkout", params={"username": username}).raise_for_status()
+    assert stock(name) == (6, 6)
+
+
+def test_checkout_is_refused_when_expired_stock_went_elsewhere(client, run, make_product, make_cart, stock):
+    name = make_product(quantity=5)
+    late = make_cart({name: 4})
+    run(expire_holds, name)
+    run(expire_batch)
+
+    make_cart({name: 3})
+    response = client.post("/transactions/checkout", params={"username": late})
+    assert response.status_code == 406
+    assert stock(name) == (5, 2)
+    assert run(reserved, name) == 3
+
+
+def test_checkout_sells_exactly_what_the_cart_held(client, run, make_product, make_cart, stock):
+    sold, other = make_product(quantity=10), make_product(quantity=10)
+    buyer = make_cart({sold: 3})
+    make_cart({sold: 2, other: 5})
+    assert stock(sold) == (10, 5)
+
+    client.post("/transactions/checkout", params={"username": buyer}).raise_for_status()
+    # on hand drops by the sale, the other cart's hold still counts against available
+    assert stock(sold) == (7, 5)
+    assert stock(other) == (10, 5)
+    assert run(reserved, sold) == 2
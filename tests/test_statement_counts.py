@@ -0,0 +1,67 @@
+import contextlib
+import json
+import uuid
+
+from sqlalchemy import event
+
+import database
+
+
+@contextlib.contextmanager
+def count_statements():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = database.async_engine.sync_engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+# a user with a cart holding one unit of each of `lines` new products
+def cart_with_lines(client, lines: int):
+    prefix = uuid.uuid4().hex[:8]
+    username = f"{prefix}-user"
+    client.post("/users/register", json={
+        "username": username, "email": f"{username}@example.com", "full_name": username, "password": "secret",
+    }).raise_for_status()
+    client.post("/carts/new-cart", params={"your_name": username}).raise_for_status()
+
+    names = [f"{prefix}-product-{i}" for i in range(lines)]
+    body = "\n".join(
+        json.dumps({"name": name, "description": "counted", "price": 2.5, "quantity": 100}) for name in names
+    )
+    client.post("/products/bulk-import", content=body.encode()).raise_for_status()
+    client.post("/carts/batch", params={"username": username}, json={
+        "operations": [{"op": "add", "product_name": name, "quantity": 1} for name in names],
+    }).raise_for_status()
+    return username
+
+
+def statements_per_request(client, method: str, path: str, usernames):
+    counts = []
+    for username in usernames:
+        # the first request of a user looks up the cart, later ones find it cached
+        client.get("/carts/view-items", params={"username": username}).raise_for_status()
+        with count_statements() as statements:
+            client.request(method, path, params={"username": username}).raise_for_status()
+        counts.append(len(statements))
+    return counts
+
+
+def test_view_items_statements_do_not_grow_with_lines(client):
+    usernames = [cart_with_lines(client, 1), cart_with_lines(client, 50)]
+    small, large = statements_per_request(client, "GET", "/carts/view-items", usernames)
+    assert small == large
+
+
+def test_checkout_statements_do_not_grow_with_lines(client):
+    usernames = [cart_with_lines(client, 1), cart_with_lines(client, 50)]
+    small, large = statements_per_request(client, "GET", "/transactions/checkout", usernames)
+    assert small == large
+    small, large = statements_per_request(client, "POST", "/transactions/checkout", usernames)
+    assert small == large
@@ -0,0 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+# more buyers than stock at once: exactly the stock is reserved, the rest get 406
+def test_concurrent_buyers_never_oversell(client, make_product, make_cart, stock):
+    name = make_product(quantity=10)
+    buyers = [make_cart() for _ in range(25)]
+
+    def buy(username: str):
+        return client.post("/carts/add-item", params={"username": username},
+                           json={"product_name": name, "quantity": 1}).status_code
+
+    with ThreadPoolExecutor(max_workers=25) as pool:
+        statuses = list(pool.map(buy, buyers))
+
+    assert statuses.count(200) == 10
+    assert statuses.count(406) == 15
+    assert stock(name) == (10, 0)
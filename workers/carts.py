@@ -0,0 +1,229 @@
+# Background cleanup of abandoned carts.
+#
+# Carts nobody changed for CART_MAX_AGE_SECONDS are deleted and the stock they still hold
+# is released; a cart that still holds unexpired stock is in use and stays. The sweeper
+# walks idle carts in (updated_at, cart_id) order, a small batch per transaction, and
+# claims them with FOR UPDATE SKIP LOCKED, so it never waits on a cart a request is
+# using and several workers never sweep the same cart.
+# Lines left with no cart by older versions, which never returned their stock, are
+# swept the same way.
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, func, tuple_, case
+
+import models
+from cart_store import cart_store
+from database import AsyncSessionLocal, env_flag, init_engines, dispose_engines
+from reservations import release_carts, sum_by_product
+
+logger = logging.getLogger(__name__)
+
+CART_SWEEPER_ENABLED = env_flag("CART_SWEEPER_ENABLED", True)
+# carts unchanged for longer than this are abandoned
+CART_MAX_AGE_SECONDS = float(os.getenv("CART_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+CART_SWEEP_INTERVAL = float(os.getenv("CART_SWEEP_INTERVAL", "300"))
+CART_SWEEP_BATCH = int(os.getenv("CART_SWEEP_BATCH", "100"))
+# seconds between batches of one sweep, leaves the database to the requests
+CART_SWEEP_PAUSE = float(os.getenv("CART_SWEEP_PAUSE", "0.05"))
+
+
+# puts product_id -> quantity back on the shelf, for stock that was taken before
+# reservations and never sold
+async def return_stock(db, returned: dict[int, int]):
+    if not returned:
+        return
+    returned_quantity = case(returned, value=models.Product.product_id)
+    await db.execute(
+        update(models.Product)
+        .where(models.Product.product_id.in_(list(returned)))
+        .values(
+            quantity=models.Product.quantity + returned_quantity,
+            available=models.Product.available + returned_quantity,
+            **models.product_version_bump(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+# deletes carts the caller has locked, with their lines, and releases the stock they hold;
+# the caller commits. Returns the number of lines and of units released
+async def delete_carts(db, cart_ids: list[int]):
+    units = await release_carts(cart_ids, db)
+    result = await db.execute(
+        delete(models.CartItem)
+        .where(models.CartItem.cart_id.in_(cart_ids))
+        .execution_options(synchronize_session=False)
+    )
+    lines = result.rowcount
+    await db.execute(
+        delete(models.Cart)
+        .where(models.Cart.cart_id.in_(cart_ids))
+        .execution_options(synchronize_session=False)
+    )
+    return lines, units
+
+
+# updated_at is written by the database clock, so the cutoff comes from it too
+def abandoned_before(db, max_age: float):
+    if db.bind.dialect.name == "sqlite":
+        return func.datetime("now", f"-{int(max_age)} seconds")
+    return func.now() - timedelta(seconds=max_age)
+
+
+class CartSweeper:
+    def __init__(self, max_age: float = CART_MAX_AGE_SECONDS, interval: float = CART_SWEEP_INTERVAL,
+                 batch_size: int = CART_SWEEP_BATCH):
+        self.max_age = max_age
+        self.interval = interval
+        self.batch_size = batch_size
+        self.task = None
+        self.sweeps = 0
+        self.batches = 0
+        self.carts_deleted = 0
+        self.lines_deleted = 0
+        self.orphans_deleted = 0
+        self.units_returned = 0
+        self.errors = 0
+        self.last_sweep_seconds = 0.0
+        self.last_batch_seconds = 0.0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                self.errors += 1
+                logger.exception("cart sweep failed")
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self):
+        start = time.perf_counter()
+        after = None
+        while True:
+            after = await self.sweep_carts(after)
+            if after is None:
+                break
+            await asyncio.sleep(CART_SWEEP_PAUSE)
+        while await self.sweep_orphans() >= self.batch_size:
+            await asyncio.sleep(CART_SWEEP_PAUSE)
+        self.sweeps += 1
+        self.last_sweep_seconds = time.perf_counter() - start
+
+    # one batch of abandoned carts after the (updated_at, cart_id) cursor; returns the
+    # cursor of the next batch, None once the idle carts are done
+    async def sweep_carts(self, after: tuple | None):
+        start = time.perf_counter()
+        async with AsyncSessionLocal() as db:
+            # expires_at is written by the application clock
+            held = (
+                select(models.StockReservation.reservation_id)
+                .where(
+                    models.StockReservation.cart_id == models.Cart.cart_id,
+                    models.StockReservation.expires_at > datetime.utcnow(),
+                )
+                .exists()
+            )
+            query = (
+                select(models.Cart.updated_at, models.Cart.cart_id)
+                .where(models.Cart.updated_at < abandoned_before(db, self.max_age), ~held)
+                .order_by(models.Cart.updated_at, models.Cart.cart_id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            if after is not None:
+                query = query.where(tuple_(models.Cart.updated_at, models.Cart.cart_id) > after)
+            rows = (await db.execute(query)).all()
+            if not rows:
+                return None
+
+            # a cart held by a write-behind store is in use, whatever its age
+            cart_ids = [row.cart_id for row in rows if not cart_store.held(row.cart_id)]
+            lines = units = 0
+            if cart_ids:
+                lines, units = await delete_carts(db, cart_ids)
+            await db.commit()
+
+        for cart_id in cart_ids:
+            await cart_store.discard(cart_id)
+        self.batches += 1
+        self.carts_deleted += len(cart_ids)
+        self.lines_deleted += lines
+        self.units_returned += units
+        self.last_batch_seconds = time.perf_counter() - start
+        if len(rows) < self.batch_size:
+            return None
+        return tuple(rows[-1])
+
+    # one batch of lines whose cart was deleted before carts cascaded to their lines
+    async def sweep_orphans(self):
+        async with AsyncSessionLocal() as db:
+            orphans = (
+                select(models.CartItem.cart_item_id)
+                .where(models.CartItem.cart_id.is_(None))
+                .order_by(models.CartItem.cart_item_id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            result = await db.execute(
+                delete(models.CartItem)
+                .where(models.CartItem.cart_item_id.in_(orphans.scalar_subquery()))
+                .returning(models.CartItem.product_id, models.CartItem.quantity)
+                .execution_options(synchronize_session=False)
+            )
+            lines = result.all()
+            returned = sum_by_product(lines)
+            await return_stock(db, returned)
+            await db.commit()
+
+        self.orphans_deleted += len(lines)
+        self.units_returned += sum(returned.values())
+        return len(lines)
+
+    def stats(self):
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "sweeps": self.sweeps,
+            "batches": self.batches,
+            "carts_deleted": self.carts_deleted,
+            "lines_deleted": self.lines_deleted,
+            "orphans_deleted": self.orphans_deleted,
+            "units_returned": self.units_returned,
+            "errors": self.errors,
+            "last_sweep_ms": round(self.last_sweep_seconds * 1000, 3),
+            "last_batch_ms": round(self.last_batch_seconds * 1000, 3),
+        }
+
+
+cart_sweeper = CartSweeper()
+
+
+# dedicated sweeper process, for deployments that keep it off the web workers
+async def main():
+    init_engines()
+    cart_sweeper.start()
+    try:
+        await cart_sweeper.task
+    finally:
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,204 @@
+# Background fulfilment of orders created by /transactions/checkout.
+#
+# Orders wait in the transactions table with status pending. The worker claims
+# them in batches with SELECT ... FOR UPDATE SKIP LOCKED, so several workers
+# (in the app processes or started with `python -m workers.orders`) never take
+# the same order, and no broker is needed.
+import asyncio
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, or_, and_, func, case
+
+import models
+from database import AsyncSessionLocal, env_flag, init_engines, dispose_engines
+
+logger = logging.getLogger(__name__)
+
+ORDER_WORKER_ENABLED = env_flag("ORDER_WORKER_ENABLED", True)
+ORDER_BATCH_SIZE = int(os.getenv("ORDER_BATCH_SIZE", "50"))
+# seconds between polls when no checkout in this process woke the worker up
+ORDER_POLL_INTERVAL = float(os.getenv("ORDER_POLL_INTERVAL", "2"))
+# an order left in processing this long belonged to a worker that died, it is claimed again
+ORDER_LEASE_SECONDS = float(os.getenv("ORDER_LEASE_SECONDS", "300"))
+# payment simulation
+PAYMENT_DELAY = float(os.getenv("PAYMENT_DELAY", "0.05"))
+PAYMENT_FAILURE_RATE = float(os.getenv("PAYMENT_FAILURE_RATE", "0"))
+
+
+class OrderWorker:
+    def __init__(self, batch_size: int = ORDER_BATCH_SIZE, poll_interval: float = ORDER_POLL_INTERVAL):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.batches = 0
+        self.completed = 0
+        self.failed = 0
+        self.errors = 0
+        self.last_batch_seconds = 0.0
+
+    # called after a checkout commits, so the order does not wait for the next poll
+    def notify(self):
+        self.wakeup.set()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                processed = await self.process_batch()
+            except Exception:
+                self.errors += 1
+                logger.exception("order batch failed")
+                processed = 0
+            # a full batch means more orders are probably waiting
+            if processed >= self.batch_size:
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def claim_orders(self, db):
+        stale = datetime.utcnow() - timedelta(seconds=ORDER_LEASE_SECONDS)
+        claimable = (
+            select(models.Transaction.transaction_id)
+            .where(or_(
+                models.Transaction.status == "pending",
+                and_(models.Transaction.status == "processing", models.Transaction.updated_at < stale),
+            ))
+            .order_by(models.Transaction.transaction_id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        result = await db.execute(
+            update(models.Transaction)
+            .where(models.Transaction.transaction_id.in_(claimable.scalar_subquery()))
+            .values(status="processing")
+            .returning(models.Transaction.transaction_id)
+            .execution_options(synchronize_session=False)
+        )
+        claimed = result.scalars().all()
+        await db.commit()
+        return claimed
+
+    async def charge(self, order_ids: list[int]):
+        # stands in for the payment provider, one call per batch
+        await asyncio.sleep(PAYMENT_DELAY)
+        return {order_id: random.random() >= PAYMENT_FAILURE_RATE for order_id in order_ids}
+
+    # stock was sold at checkout, failed orders put it back on the shelf
+    async def restock(self, db, order_ids: list[int]):
+        result = await db.execute(
+            select(models.TransactionLine.product_id, func.sum(models.TransactionLine.quantity))
+            .where(
+                models.TransactionLine.transaction_id.in_(order_ids),
+                models.TransactionLine.product_id.is_not(None),
+            )
+            .group_by(models.TransactionLine.product_id)
+        )
+        returned = dict(result.all())
+        if not returned:
+            return
+        returned_quantity = case(returned, value=models.Product.product_id)
+        await db.execute(
+            update(models.Product)
+            .where(models.Product.product_id.in_(list(returned)))
+            .values(
+                quantity=models.Product.quantity + returned_quantity,
+                available=models.Product.available + returned_quantity,
+                **models.product_version_bump(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    # the outcome of claimed orders, with the stock of declined ones, in one transaction.
+    # A batch that outlived its lease may have been claimed again meanwhile: only orders
+    # still in processing move, so the first outcome stays and stock returns once.
+    # Returns the ids moved to completed and to failed
+    async def finish_orders(self, db, payments: dict[int, bool]):
+        paid = [order_id for order_id, ok in payments.items() if ok]
+        declined = [order_id for order_id, ok in payments.items() if not ok]
+        failed = completed = []
+        if declined:
+            result = await db.execute(
+                update(models.Transaction)
+                .where(models.Transaction.transaction_id.in_(declined), models.Transaction.status == "processing")
+                .values(status="failed", failure_reason="payment declined")
+                .returning(models.Transaction.transaction_id)
+                .execution_options(synchronize_session=False)
+            )
+            failed = result.scalars().all()
+            if failed:
+                await self.restock(db, failed)
+        if paid:
+            result = await db.execute(
+                update(models.Transaction)
+                .where(models.Transaction.transaction_id.in_(paid), models.Transaction.status == "processing")
+                .values(status="completed")
+                .returning(models.Transaction.transaction_id)
+                .execution_options(synchronize_session=False)
+            )
+            completed = result.scalars().all()
+        await db.commit()
+        return completed, failed
+
+    async def process_batch(self):
+        start = time.perf_counter()
+        async with AsyncSessionLocal() as db:
+            order_ids = await self.claim_orders(db)
+            if not order_ids:
+                return 0
+
+            payments = await self.charge(order_ids)
+            completed, failed = await self.finish_orders(db, payments)
+
+        self.batches += 1
+        self.completed += len(completed)
+        self.failed += len(failed)
+        self.last_batch_seconds = time.perf_counter() - start
+        return len(order_ids)
+
+    def stats(self):
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "batches": self.batches,
+            "completed": self.completed,
+            "failed": self.failed,
+            "errors": self.errors,
+            "last_batch_ms": round(self.last_batch_seconds * 1000, 3),
+        }
+
+
+order_worker = OrderWorker()
+
+
+# dedicated worker process, for deployments that keep fulfilment off the web workers
+async def main():
+    init_engines()
+    order_worker.start()
+    try:
+        await order_worker.task
+    finally:
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
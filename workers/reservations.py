@@ -0,0 +1,118 @@
+# Background release of expired stock reservations.
+#
+# Expired holds are released oldest first, a batch per transaction, claimed with
+# FOR UPDATE SKIP LOCKED so a checkout settling the same cart is never waited on and
+# several workers never release the same hold. The cart lines stay; checkout reserves
+# their stock again if it is still available.
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import select, delete
+
+import models
+from database import AsyncSessionLocal, env_flag, init_engines, dispose_engines
+from reservations import make_available, sum_by_product
+
+logger = logging.getLogger(__name__)
+
+RESERVATION_EXPIRY_ENABLED = env_flag("RESERVATION_EXPIRY_ENABLED", True)
+RESERVATION_EXPIRY_INTERVAL = float(os.getenv("RESERVATION_EXPIRY_INTERVAL", "30"))
+RESERVATION_EXPIRY_BATCH = int(os.getenv("RESERVATION_EXPIRY_BATCH", "500"))
+
+
+class ReservationExpirer:
+    def __init__(self, interval: float = RESERVATION_EXPIRY_INTERVAL, batch_size: int = RESERVATION_EXPIRY_BATCH):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.task = None
+        self.batches = 0
+        self.released = 0
+        self.units_released = 0
+        self.errors = 0
+        self.last_batch_seconds = 0.0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                released = await self.expire_batch()
+            except Exception:
+                self.errors += 1
+                logger.exception("reservation expiry failed")
+                released = 0
+            # a full batch means more holds have probably expired
+            if released >= self.batch_size:
+                continue
+            await asyncio.sleep(self.interval)
+
+    async def expire_batch(self):
+        start = time.perf_counter()
+        async with AsyncSessionLocal() as db:
+            expired = (
+                select(models.StockReservation.reservation_id)
+                .where(models.StockReservation.expires_at < datetime.utcnow())
+                .order_by(models.StockReservation.expires_at)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            result = await db.execute(
+                delete(models.StockReservation)
+                .where(models.StockReservation.reservation_id.in_(expired.scalar_subquery()))
+                .returning(models.StockReservation.product_id, models.StockReservation.quantity)
+                .execution_options(synchronize_session=False)
+            )
+            holds = result.all()
+            if not holds:
+                return 0
+            returned = sum_by_product(holds)
+            await make_available(returned, db)
+            await db.commit()
+
+        self.batches += 1
+        self.released += len(holds)
+        self.units_released += sum(returned.values())
+        self.last_batch_seconds = time.perf_counter() - start
+        return len(holds)
+
+    def stats(self):
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "batches": self.batches,
+            "released": self.released,
+            "units_released": self.units_released,
+            "errors": self.errors,
+            "last_batch_ms": round(self.last_batch_seconds * 1000, 3),
+        }
+
+
+reservation_expirer = ReservationExpirer()
+
+
+# dedicated expiry process, for deployments that keep it off the web workers
+async def main():
+    init_engines()
+    reservation_expirer.start()
+    try:
+        await reservation_expirer.task
+    finally:
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())